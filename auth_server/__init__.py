@@ -1,42 +1,96 @@
 import os
+import time
+# the startup time of the first app of this process counts the imports below. a worker forked by a master that
+# imported the package, e.g. for the gunicorn hooks, counts from its create_app instead, as it inherits the imports
+_started_at = time.perf_counter()
+_started_pid = os.getpid()
+
 from datetime import timedelta
 from flask import Flask, send_from_directory
-from logging.config import dictConfig
+from logging import getLogger
+import logging
 import sys
+import redis
 from flask.views import MethodView
 from flask_jwt_extended import JWTManager
-from flask_swagger_ui import get_swaggerui_blueprint
 from auth_server import config
-from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from flask_admin import Admin
+from auth_server.utils.blacklist import UserBlackList
+from auth_server.utils.cache import TTLCache
+from auth_server.utils.keys import KeyRing
+from auth_server.utils.logs import JsonFormatter, QueueLogHandler, RateLimitFilter
+from auth_server.utils.policy_version import PolicyVersion
 
 # lazy extensions
 db_wrapper = SQLAlchemy()
 
 jwt = JWTManager()
 
+key_ring = KeyRing()
+
 admin = None
 
+# revoked tokens, shares one redis connection pool per process
+blacklist = UserBlackList()
+
+# version of the roles/resources graph, embedded in tokens carrying their resources
+policy_version = PolicyVersion()
+
+# version of users, roles, resources and their relations, tagging the responses listing them
+identity_version = PolicyVersion("REDIS_IDENTITY_VERSION")
+
+# per-worker cache of authorization decisions, see LocalUserManager.authorize
+authorization_cache = TTLCache("authorization decisions")
+
+# per-worker cache of verified tokens, see auth_server.utils.jwt.decode_verified_token
+jwt_cache = TTLCache("verified tokens")
+
+# per-worker cache of the roles of admin panel users, see auth_server.views.flask_admin_views.admin_roles
+admin_auth_cache = TTLCache("admin credentials")
+
+# the profiles create_app can build, 'authorize' serves only the auth blueprint and leaves the
+# identity views, flask admin, swagger ui and CORS unimported
+PROFILES = ("full", "authorize")
+
 
-def create_app(extra_configs: dict=None) -> Flask:
+def create_app(extra_configs: dict=None, profile: str=None) -> Flask:
     """Creates the application object
 
     :param extra_configs: the dictionary from which the flask app.config updates from. it overrides the default configs.
+    :param profile: one of PROFILES, default is the APP_PROFILE env variable or 'full'.
     """
+    global _started_at
+    started_at = _started_at if _started_at is not None and _started_pid == os.getpid() else time.perf_counter()
+    _started_at = None
+    profile = profile or os.environ.get("APP_PROFILE", "full")
+    if profile not in PROFILES:
+        raise ValueError("APP_PROFILE should be one of {}".format(", ".join(PROFILES)))
     app = Flask(__name__)
+    app.config["APP_PROFILE"] = profile
 
     # set logging
     level = os.environ.get("LOG_LEVEL", default='INFO').upper()
     prefix = os.environ.get("LOG_PREFIX", default="AuthServer")
-    set_logging(level=level, prefix=prefix)
+    set_logging(
+        level=level,
+        prefix=prefix,
+        log_format=os.environ.get("LOG_FORMAT", "json").lower(),
+        queue_size=int(os.environ.get("LOG_QUEUE_SIZE", 10000)),
+        rate_limit=int(os.environ.get("LOG_RATE_LIMIT", 10)),
+        rate_interval=float(os.environ.get("LOG_RATE_INTERVAL", 1))
+    )
 
     # jwt flask extended
     jwt.init_app(app)
+    app.config["JWT_ALGORITHM"] = os.environ.get("JWT_ALGORITHM", "HS256")
     jwt_secret = os.environ.get("JWT_SECRET_KEY", None)
-    if jwt_secret is None:
+    if jwt_secret is None and app.config["JWT_ALGORITHM"].startswith("HS"):
         raise TypeError("no JWT_SECRET_KEY env variable")
     app.config["JWT_SECRET_KEY"] = jwt_secret
+    app.config["JWT_PRIVATE_KEY_FILE"] = os.environ.get("JWT_PRIVATE_KEY_FILE", None)
+    app.config["JWT_KEY_ID"] = os.environ.get("JWT_KEY_ID", None)
+    app.config["JWT_PUBLIC_KEYS_DIR"] = os.environ.get("JWT_PUBLIC_KEYS_DIR", None)
+    app.config["JWKS_MAX_AGE"] = int(os.environ.get("JWKS_MAX_AGE", 3600))
     app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(
         minutes=int(os.environ.get("JWT_ACCESS_TOKEN_EXPIRES", 10803))
     )
@@ -49,26 +103,146 @@ def create_app(extra_configs: dict=None) -> Flask:
     # sqlAlchemy
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URI", "postgres://postgres@postgres:5432/auth")
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    global db_wrapper
-    db_wrapper = SQLAlchemy(app)
+    # the models are bound to this instance at import, so it is initialized rather than replaced
+    db_wrapper.init_app(app)
+    app.config["REPLICA_DATABASE_URIS"] = list(filter(None, os.environ.get("REPLICA_DATABASE_URIS", "").split(",")))
+    app.config["REPLICA_RETRY_INTERVAL"] = float(os.environ.get("REPLICA_RETRY_INTERVAL", 5))
+    app.config["REPLICA_STICKY_SECONDS"] = float(os.environ.get("REPLICA_STICKY_SECONDS", 5))
 
     # redis config
     app.config["REDIS_HOST"] = os.environ.get("REDIS_HOST", "redis")
     app.config["REDIS_PORT"] = int(os.environ.get("REDIS_PORT", 6379))
     app.config["REDIS_BLACKLIST"] = os.environ.get("REDIS.GENERAL", "blacklist")
+    app.config["REDIS_POLICY_VERSION"] = os.environ.get("REDIS_POLICY_VERSION", "policy_version")
+    app.config["REDIS_IDENTITY_VERSION"] = os.environ.get("REDIS_IDENTITY_VERSION", "identity_version")
+    app.config["REDIS_MAX_CONNECTIONS"] = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+    app.config["REDIS_BLACKLIST_SWEEP_INTERVAL"] = float(os.environ.get("REDIS_BLACKLIST_SWEEP_INTERVAL", 60))
+    app.config["REDIS_BLACKLIST_MIRROR"] = os.environ.get("REDIS_BLACKLIST_MIRROR", "false").lower() == "true"
+    app.config["REDIS_BLACKLIST_MIRROR_INTERVAL"] = float(os.environ.get("REDIS_BLACKLIST_MIRROR_INTERVAL", 1))
+    app.config["REDIS_BLACKLIST_MIRROR_CAPACITY"] = int(os.environ.get("REDIS_BLACKLIST_MIRROR_CAPACITY", 100000))
+
+    # authorization decision cache
+    app.config["AUTHORIZATION_CACHE_SIZE"] = int(os.environ.get("AUTHORIZATION_CACHE_SIZE", 10000))
+    app.config["AUTHORIZATION_CACHE_TTL"] = int(os.environ.get("AUTHORIZATION_CACHE_TTL", 60))
+    app.config["JWT_CACHE_SIZE"] = int(os.environ.get("JWT_CACHE_SIZE", 10000))
+    app.config["JWT_CACHE_TTL"] = int(os.environ.get("JWT_CACHE_TTL", 3600))
+    app.config["ADMIN_AUTH_CACHE_SIZE"] = int(os.environ.get("ADMIN_AUTH_CACHE_SIZE", 100))
+    app.config["ADMIN_AUTH_CACHE_TTL"] = int(os.environ.get("ADMIN_AUTH_CACHE_TTL", 300))
+    app.config["AUTHORIZE_BATCH_SIZE"] = int(os.environ.get("AUTHORIZE_BATCH_SIZE", 1000))
+    app.config["BULK_CREATE_CHUNK_SIZE"] = int(os.environ.get("BULK_CREATE_CHUNK_SIZE", 1000))
+    app.config["BULK_CREATE_MAX_ITEMS"] = int(os.environ.get("BULK_CREATE_MAX_ITEMS", 100))
+    app.config["PAGE_SIZE_MAX"] = int(os.environ.get("PAGE_SIZE_MAX", 1000))
+    app.config["AVATAR_MAX_AGE"] = int(os.environ.get("AVATAR_MAX_AGE", 31536000))
+    app.config["GZIP_MIN_SIZE"] = int(os.environ.get("GZIP_MIN_SIZE", 1024))
+    app.config["GZIP_LEVEL"] = int(os.environ.get("GZIP_LEVEL", 6))
+
+    # in-memory index of the roles/resources graph
+    app.config["POLICY_INDEX"] = os.environ.get("POLICY_INDEX", "true").lower() == "true"
+    app.config["POLICY_INDEX_CHECK_INTERVAL"] = float(os.environ.get("POLICY_INDEX_CHECK_INTERVAL", 1))
+    app.config["POLICY_INDEX_FALLBACK_INTERVAL"] = float(os.environ.get("POLICY_INDEX_FALLBACK_INTERVAL", 30))
+
+    # password hashing
+    app.config["PASSWORD_HASHER"] = os.environ.get("PASSWORD_HASHER", "pbkdf2_sha256")
+    app.config["PASSWORD_PBKDF2_ITERATIONS"] = int(os.environ.get("PASSWORD_PBKDF2_ITERATIONS", 100000))
+    app.config["PASSWORD_SCRYPT_N"] = int(os.environ.get("PASSWORD_SCRYPT_N", 16384))
+    app.config["PASSWORD_SCRYPT_R"] = int(os.environ.get("PASSWORD_SCRYPT_R", 8))
+    app.config["PASSWORD_SCRYPT_P"] = int(os.environ.get("PASSWORD_SCRYPT_P", 1))
+    app.config["PASSWORD_HASH_CONCURRENCY"] = int(os.environ.get("PASSWORD_HASH_CONCURRENCY", 2))
+    app.config["PASSWORD_HASH_QUEUE_TIMEOUT"] = float(os.environ.get("PASSWORD_HASH_QUEUE_TIMEOUT", 1))
+    app.config["PASSWORD_HASH_SLOTS_DIR"] = os.environ.get("PASSWORD_HASH_SLOTS_DIR", "/tmp/password_hash_slots")
+
+    # asyncio mode, see auth_server.async_app
+    app.config["ASYNC_DB_POOL_SIZE"] = int(os.environ.get("ASYNC_DB_POOL_SIZE", 10))
+
+    # profiling, see auth_server.utils.profiling
+    app.config["PROFILING"] = os.environ.get("PROFILING", "false").lower() == "true"
+    app.config["PROFILE_SAMPLE_PERCENT"] = float(os.environ.get("PROFILE_SAMPLE_PERCENT", 0))
+    app.config["PROFILE_HEADER"] = os.environ.get("PROFILE_HEADER", "X-Profile")
+    app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+
+    # tokens embedding their resources
+    app.config["EMBED_RESOURCES_USERS"] = set(filter(None, os.environ.get("EMBED_RESOURCES_USERS", "").split(",")))
+    app.config["EMBED_RESOURCES_SERVICES"] = set(
+        filter(None, os.environ.get("EMBED_RESOURCES_SERVICES", "").split(","))
+    )
 
     if extra_configs is not None:
         app.config.update(extra_configs)
 
-    # add swagger ui
-    set_api_doc(app)
+    key_ring.init_app(app)
+    redis_client = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+        host=app.config['REDIS_HOST'],
+        port=app.config['REDIS_PORT'],
+        max_connections=app.config['REDIS_MAX_CONNECTIONS']
+    ))
+    blacklist.init_app(app, redis_client)
+    policy_version.init_app(app, redis_client)
+    identity_version.init_app(app, redis_client)
+    authorization_cache.configure(
+        maxsize=app.config["AUTHORIZATION_CACHE_SIZE"],
+        ttl=app.config["AUTHORIZATION_CACHE_TTL"]
+    )
+    jwt_cache.configure(
+        maxsize=app.config["JWT_CACHE_SIZE"],
+        ttl=app.config["JWT_CACHE_TTL"]
+    )
+    admin_auth_cache.configure(
+        maxsize=app.config["ADMIN_AUTH_CACHE_SIZE"],
+        ttl=app.config["ADMIN_AUTH_CACHE_TTL"]
+    )
+
+    from auth_server.models.policy_index import policy_index
+    policy_index.configure(
+        enabled=app.config["POLICY_INDEX"],
+        check_interval=app.config["POLICY_INDEX_CHECK_INTERVAL"],
+        fallback_interval=app.config["POLICY_INDEX_FALLBACK_INTERVAL"]
+    )
+
+    # read only queries of the hot paths are spread over the replicas
+    from auth_server.models.replicas import replicas
+    replicas.init_app(app, db_wrapper.get_engine(app))
+
+    from auth_server.utils.password import password_hasher
+    password_hasher.init_app(app)
+
+    if profile == "full":
+        # add swagger ui
+        set_api_doc(app)
+
+        # CORS
+        from flask_cors import CORS
+        CORS(app)
 
-    # CORS
-    CORS(app)
+    # profiling of sampled requests, registered first so it covers the other request hooks
+    from auth_server.utils import profiling
+    profiling.init_app(app)
+
+    # prometheus metrics, registered before compression so its time is measured
+    from auth_server.utils import metrics
+    metrics.init_app(app, db_wrapper.get_engine(app))
+    for engine in replicas.engines:
+        metrics.instrument(engine)
+
+    # gzip of large json responses
+    from auth_server.utils.compression import compress_response
+    app.after_request(compress_response)
 
     # blueprints
     from auth_server.views.auth_views import auth_bp
     app.register_blueprint(auth_bp)
+    if app.config["PROFILING"]:
+        from auth_server.views.debug_views import TracemallocView
+        app.add_url_rule('/debug/tracemalloc', view_func=TracemallocView.as_view("tracemalloc"))
+    if profile == "full":
+        register_identity_views(app)
+    seconds = time.perf_counter() - started_at
+    metrics.startup_seconds.labels(profile).observe(seconds)
+    getLogger().info("{} app created in {:.3f} seconds".format(profile, seconds))
+    return app
+
+
+def register_identity_views(app: Flask):
+    """Registers the identity blueprint, the identity methodViews and flask admin"""
     from auth_server.views.identity_views import identity_bp
     app.register_blueprint(identity_bp)
 
@@ -90,31 +264,39 @@ def create_app(extra_configs: dict=None) -> Flask:
 
     # flask admin
     global admin
+    from flask_admin import Admin
     from auth_server.views.flask_admin_views import IndexView
     admin = Admin(name='AuthServer', template_mode='bootstrap3', app=app, index_view=IndexView())
     from auth_server.views.flask_admin_views import register
     register()
-    return app
 
 
-def set_logging(level='INFO', prefix=''):
+def set_logging(level='INFO', prefix='', log_format='json', queue_size=10000, rate_limit=10, rate_interval=1.0):
+    """Logs the records of the root logger to stdout by a writer thread, see auth_server.utils.logs
+
+    :param log_format: 'json' for a json object per line or 'text'.
+    :param queue_size: number of records waiting for the writer thread before new ones are dropped.
+    :param rate_limit: number of records of a call site logged per rate_interval seconds, 0 logs all of them.
+    """
     if level not in ("INFO", "DEBUG", "WARNING"):
         raise ValueError("LOG_LEVEL should be one of INFO, DEBUG or WARNING")
-    dictConfig({
-        'version': 1,
-        'formatters': {'default': {
-            'format': '{} [%(asctime)s] %(levelname)s in %(module)s: %(message)s'.format(prefix)
-        }},
-        'handlers': {'stream': {
-            'class': 'logging.StreamHandler',
-            'stream': sys.stdout,
-            'formatter': 'default',
-        }},
-        'root': {
-            'level': level,
-            'handlers': ['stream']
-        }
-    })
+    if log_format not in ("json", "text"):
+        raise ValueError("LOG_FORMAT should be one of json or text")
+    stream = logging.StreamHandler(sys.stdout)
+    if log_format == "json":
+        stream.setFormatter(JsonFormatter(prefix))
+    else:
+        stream.setFormatter(logging.Formatter(
+            '{} [%(asctime)s] %(levelname)s in %(module)s: %(message)s'.format(prefix)
+        ))
+    handler = QueueLogHandler(stream, maxsize=queue_size)
+    handler.addFilter(RateLimitFilter(rate_limit, rate_interval))
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+        old_handler.close()
+    root.addHandler(handler)
+    root.setLevel(level)
 
 
 def register_methodview(app: Flask, m_view: MethodView, path: str, url_prefix=''):
@@ -151,6 +333,7 @@ def register_methodview(app: Flask, m_view: MethodView, path: str, url_prefix=''
 
 
 def set_api_doc(app: Flask):
+    from flask_swagger_ui import get_swaggerui_blueprint
     api_yaml_url = '/api_doc_file'
     api_doc = "/api_docs"
     swaggerui_blueprint = get_swaggerui_blueprint(
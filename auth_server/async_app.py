@@ -0,0 +1,261 @@
+import asyncio
+import time
+from logging import getLogger
+import aioredis
+import asyncpg
+from aiohttp import web, hdrs
+from flask_jwt_extended.config import config
+from flask_jwt_extended.exceptions import NoAuthorizationError, InvalidHeaderError
+from marshmallow import ValidationError
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from auth_server import create_app, blacklist
+from auth_server.config import url_prefix
+from auth_server.models.policy_index import policy_index, PolicyIndex
+from auth_server.serializers.auth_serializers import AuthorizeInput, AuthorizeOutput, BatchAuthorizeOutput
+from auth_server.serializers.identity_serializers import ResourceSerializer
+from auth_server.serializers.registry import schema, dumps
+from auth_server.user_manager.local_user_manager import LocalUserManager
+from auth_server.utils import fast_json
+from auth_server.utils.jwt import token_from_header
+from auth_server.utils.metrics import request_seconds, db_query_seconds, redis_command_seconds, metrics
+from auth_server.utils.policy import resources_tag
+from auth_server.views.auth_views import token_roles, TokenRejected
+
+user_manger_class = LocalUserManager
+
+resources_sql = str(PolicyIndex.resources_query.compile(dialect=postgresql.dialect()))
+
+relations_sql = str(PolicyIndex.relations_query.compile(dialect=postgresql.dialect()))
+
+
+def create_async_app(extra_configs: dict=None) -> web.Application:
+    """Creates the asyncio application serving the authorize, authorize/batch and user_resources endpoints
+
+    it is configured like the flask application of the 'authorize' profile, whose tokens, caches and serializers
+    it shares, but waits on redis and postgres by asynchronous clients with a pool each.
+    authorization is always answered from the policy index, which is refreshed by this application.
+    :param extra_configs: the dictionary from which the flask app.config updates from.
+    """
+    flask_app = create_app(extra_configs, profile="authorize")
+    policy_index.configure(
+        enabled=True,
+        check_interval=flask_app.config["POLICY_INDEX_CHECK_INTERVAL"],
+        fallback_interval=flask_app.config["POLICY_INDEX_FALLBACK_INTERVAL"],
+        self_refresh=False
+    )
+    app = web.Application(middlewares=[observe_request])
+    app["flask_app"] = flask_app
+    app["policy_index_lock"] = asyncio.Lock()
+    app.on_startup.append(open_pools)
+    app.on_cleanup.append(close_pools)
+    # served without PrefixMiddleware, so the routes carry the prefix
+    app.router.add_post(url_prefix + "/authorize", authorize)
+    app.router.add_post(url_prefix + "/authorize/batch", authorize_batch)
+    app.router.add_get(url_prefix + "/user_resources", get_user_resources)
+    app.router.add_get(url_prefix + "/metrics", get_metrics)
+    return app
+
+
+async def open_pools(app: web.Application):
+    flask_app = app["flask_app"]
+    # handlers run in the thread of the event loop, so one app context serves all of them
+    app["flask_context"] = flask_app.app_context()
+    app["flask_context"].push()
+    db_url = make_url(flask_app.config["SQLALCHEMY_DATABASE_URI"])
+    db_url.drivername = "postgresql"
+    app["db"] = await asyncpg.create_pool(str(db_url), min_size=1, max_size=flask_app.config["ASYNC_DB_POOL_SIZE"])
+    app["redis"] = await aioredis.create_redis_pool(
+        (flask_app.config["REDIS_HOST"], flask_app.config["REDIS_PORT"]),
+        maxsize=flask_app.config["REDIS_MAX_CONNECTIONS"]
+    )
+
+
+async def close_pools(app: web.Application):
+    app["redis"].close()
+    await app["redis"].wait_closed()
+    await app["db"].close()
+    app["flask_context"].pop()
+
+
+async def sync_policy_index(app: web.Application):
+    """Rebuilds the policy index if the policy version moved, like PolicyIndex.sync by the asynchronous clients"""
+    lock = app["policy_index_lock"]
+    if not policy_index.due():
+        return
+    # while one request refreshes, the others keep answering from the current index
+    if lock.locked() and not policy_index.outdated(None):
+        return
+    async with lock:
+        if not policy_index.due():
+            return
+        try:
+            version = int(await app["redis"].get(app["flask_app"].config["REDIS_POLICY_VERSION"]) or 0)
+        except (aioredis.RedisError, OSError) as e:
+            getLogger().warning("policy version is not available, the policy index is rebuilt periodically: {}".format(
+                e
+            ))
+            version = None
+        if not policy_index.outdated(version):
+            policy_index.load(version)
+            return
+        async with app["db"].acquire() as connection:
+            with db_query_seconds.labels("select").time():
+                resource_rows = await connection.fetch(resources_sql)
+            with db_query_seconds.labels("select").time():
+                relation_rows = await connection.fetch(relations_sql)
+        policy_index.load(version, resource_rows, relation_rows)
+
+
+async def tokens_in_blacklist(app: web.Application, tokens: list) -> list:
+    """Asynchronous variant of UserBlackList.tokens_in_blacklist"""
+    result = [False] * len(tokens)
+    to_check = [i for i, token in enumerate(tokens) if blacklist.may_contain(token)]
+    if not to_check:
+        return result
+    pipeline = app["redis"].pipeline()
+    for i in to_check:
+        pipeline.zscore(blacklist.key, tokens[i])
+    with redis_command_seconds.labels("zscore_pipeline").time():
+        scores = await pipeline.execute()
+    for i, score in zip(to_check, scores):
+        result[i] = score is not None
+    return result
+
+
+@web.middleware
+async def observe_request(request: web.Request, handler):
+    """Times the requests like auth_server.utils.metrics does for the flask app"""
+    started_at = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        endpoint = resource.canonical[len(url_prefix):] if resource is not None else "unmatched"
+        request_seconds.labels(endpoint, request.method, status).observe(time.perf_counter() - started_at)
+
+
+async def get_metrics(request: web.Request) -> web.Response:
+    """Asynchronous variant of the metrics view"""
+    response = metrics()
+    return web.Response(body=response.get_data(), headers={hdrs.CONTENT_TYPE: response.content_type})
+
+
+async def json_body(request: web.Request):
+    """Returns the parsed json body of the request
+
+    :raises HTTPBadRequest: if the body is not json.
+    """
+    mimetype = request.content_type
+    if not (mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))):
+        raise web.HTTPBadRequest(text="Request body should be valid json")
+    try:
+        return await request.json(loads=fast_json.loads)
+    except ValueError:
+        raise web.HTTPBadRequest(text="Request body should be valid json")
+
+
+def json_response(request: web.Request, body: str, status: int=200) -> web.Response:
+    """Returns the json response, gzipped like auth_server.utils.compression.compress_response"""
+    response = web.Response(text=body, status=status, content_type="application/json")
+    response.headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+    accepted = parse_accept_header(request.headers.get(hdrs.ACCEPT_ENCODING))
+    if len(body) >= request.app["flask_app"].config["GZIP_MIN_SIZE"] and accepted["gzip"] > 0:
+        response.enable_compression(web.ContentCoding.gzip)
+    return response
+
+
+async def authorize(request: web.Request) -> web.Response:
+    """Asynchronous variant of the authorize view, rejected tokens get the errors of the batch items"""
+    try:
+        in_data = schema(AuthorizeInput).load(await json_body(request))
+    except ValidationError as e:
+        getLogger().error("validation error for authorize request: {}".format(e))
+        return web.Response(text="bad format input for fields: {}".format(e.field_names), status=422)
+    try:
+        jti, roles = token_roles(in_data["token"])
+    except TokenRejected as e:
+        getLogger().info("authorize: token rejected, {}".format(e.message))
+        return web.Response(text=e.message, status=e.status)
+    if (await tokens_in_blacklist(request.app, [jti]))[0]:
+        getLogger().info("authorize: token in black list, jti: {}".format(jti))
+        return web.Response(text="token in black list", status=401)
+    await sync_policy_index(request.app)
+    resources = user_manger_class.authorize(roles=roles, resources=in_data["resources"])
+    return json_response(request, dumps(AuthorizeOutput, {"token": in_data["token"], "resources": resources}))
+
+
+async def authorize_batch(request: web.Request) -> web.Response:
+    """Asynchronous variant of the authorize/batch view"""
+    try:
+        in_data = schema(AuthorizeInput, many=True).load(await json_body(request))
+    except ValidationError as e:
+        getLogger().error("validation error for batch authorize request: {}".format(e.messages))
+        return web.Response(text="bad format input for items: {}".format(e.messages), status=422)
+    batch_size = request.app["flask_app"].config["AUTHORIZE_BATCH_SIZE"]
+    if len(in_data) > batch_size:
+        return web.Response(text="at most {} items are allowed in a batch".format(batch_size), status=422)
+
+    results = [{"token": item["token"]} for item in in_data]
+    valid = []
+    jwt_data_list = []
+    for i, item in enumerate(in_data):
+        try:
+            jwt_data_list.append(token_roles(item["token"]))
+        except TokenRejected as e:
+            results[i].update(error=e.message, status=e.status)
+        else:
+            valid.append(i)
+
+    revoked = await tokens_in_blacklist(request.app, [jti for jti, _ in jwt_data_list])
+    pairs = []
+    allowed = []
+    for i, (_, roles), is_revoked in zip(valid, jwt_data_list, revoked):
+        if is_revoked:
+            results[i].update(error="token in black list", status=401)
+        else:
+            allowed.append(i)
+            pairs.append((roles, in_data[i]["resources"]))
+
+    await sync_policy_index(request.app)
+    for i, resources in zip(allowed, user_manger_class.authorize_many(pairs)):
+        results[i]["resources"] = resources
+    failed = len(in_data) - len(allowed)
+    if failed:
+        getLogger().info("batch authorize: {} of {} tokens rejected".format(failed, len(in_data)))
+    return json_response(request, dumps(BatchAuthorizeOutput, results, many=True))
+
+
+async def get_user_resources(request: web.Request) -> web.Response:
+    """Asynchronous variant of the user_resources view"""
+    try:
+        jti, roles = token_roles(token_from_header(request.headers.get(config.header_name)))
+    except (NoAuthorizationError, InvalidHeaderError) as e:
+        return web.Response(text=str(e), status=401)
+    except TokenRejected as e:
+        return web.Response(text=e.message, status=e.status)
+    if (await tokens_in_blacklist(request.app, [jti]))[0]:
+        return web.Response(text="token in black list", status=401)
+    await sync_policy_index(request.app)
+    tag = resources_tag(roles)
+    if tag is not None and parse_etags(request.headers.get(hdrs.IF_NONE_MATCH)).contains_weak(tag):
+        response = web.Response(status=304)
+    else:
+        try:
+            response = json_response(
+                request,
+                dumps(ResourceSerializer, user_manger_class.user_resources(roles), many=True, exclude=("id", ))
+            )
+        except TypeError:
+            getLogger().error("token with jti '{}' have no roles so have no allowed resources".format(jti))
+            response = json_response(request, "[]")
+    if tag is not None:
+        response.headers[hdrs.ETAG] = quote_etag(tag, weak=True)
+    return response
@@ -1,10 +1,12 @@
+from functools import lru_cache
 from logging import getLogger
-from sqlalchemy import Integer, ForeignKey, and_
+from sqlalchemy import Integer, ForeignKey, and_, text, func
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.sql import select
 from auth_server import db_wrapper
 from auth_server.models.errors import DoesNotExist, ConstraintViolation
+from auth_server.models.replicas import replicas
 from auth_server.models.utils import CrudModel
 
 user_roles = db_wrapper.Table(
@@ -29,7 +31,8 @@ class Users(db_wrapper.Model, CrudModel):
     username = db_wrapper.Column(db_wrapper.String(128), unique=True, nullable=False)
     password = db_wrapper.Column(db_wrapper.String(256), nullable=False)
     display_name = db_wrapper.Column(db_wrapper.String(128), nullable=True)
-    avatar = db_wrapper.Column(db_wrapper.Text, nullable=True)
+    # up to 10KB, loaded only by get_avatar
+    avatar = deferred(db_wrapper.Column(db_wrapper.Text, nullable=True))
     service_name = db_wrapper.Column(db_wrapper.String(128), nullable=True)
     roles = relationship(
         "Roles",
@@ -42,8 +45,13 @@ class Users(db_wrapper.Model, CrudModel):
 
     @classmethod
     def get_info_by_id(cls, id):
+        """
+
+        :return: username, display_name and avatar_hash of the user, the avatar itself is served by get_avatar.
+        :raises DoesNotExist: if there is no such user.
+        """
         user = db_wrapper.session.execute(
-            select([cls.username, cls.display_name, cls.avatar]).where(cls.id == id)
+            select([cls.username, cls.display_name, func.md5(cls.avatar).label("avatar_hash")]).where(cls.id == id)
         ).first()
         db_wrapper.session.commit()
         if user is None:
@@ -51,6 +59,29 @@ class Users(db_wrapper.Model, CrudModel):
             raise DoesNotExist
         return dict(user)
 
+    @classmethod
+    def get_avatar_hash(cls, id):
+        """Returns the md5 of the avatar of the user computed by postgres, None if the user has no avatar
+
+        :raises DoesNotExist: if there is no such user.
+        """
+        user = db_wrapper.session.execute(select([func.md5(cls.avatar)]).where(cls.id == id)).first()
+        db_wrapper.session.commit()
+        if user is None:
+            raise DoesNotExist
+        return user[0]
+
+    @classmethod
+    def get_avatar(cls, id):
+        """
+        :raises DoesNotExist: if there is no such user.
+        """
+        user = db_wrapper.session.execute(select([cls.avatar]).where(cls.id == id)).first()
+        db_wrapper.session.commit()
+        if user is None:
+            raise DoesNotExist
+        return user[0]
+
 
 username_hash_index = db_wrapper.Index("username_hash_index", Users.username, postgresql_using='hash')
 
@@ -99,19 +130,50 @@ class Resources(db_wrapper.Model, CrudModel):
 resource_path_hash_index = db_wrapper.Index("resource_path_hash_index", Resources.path, postgresql_using='hash')
 
 
-def get_user_by_user_pass(username, password):
-    tuple_result = db_wrapper.session.execute(
-        "SELECT users.id, array_agg(user_roles.role_id) "
-        "FROM users LEFT JOIN user_roles ON (users.id = user_roles.user_id) "
-        "where users.username='{username}' AND users.password='{password}'"
-        "group by users.id".format(
-            username=username, password=password
-        )
-    ).first()
+# the queries below are parsed once and bound to their parameters on execution,
+# so postgres sees one statement per query whatever the arguments are
+user_by_username_query = text(
+    "SELECT users.id, users.service_name, array_agg(user_roles.role_id), users.password "
+    "FROM users LEFT JOIN user_roles ON (users.id = user_roles.user_id) "
+    "where users.username = :username "
+    "group by users.id"
+)
+
+resources_by_roles_query = text(
+    "SELECT DISTINCT resources.path, resources.value "
+    "FROM resource_roles INNER JOIN resources ON (resource_roles.resource_id=resources.id) "
+    "WHERE resources.path = ANY(:resources) AND role_id = ANY(:roles)"
+)
+
+role_resources_by_roles_query = text(
+    "SELECT resource_roles.role_id, resources.path, resources.value "
+    "FROM resource_roles INNER JOIN resources ON (resource_roles.resource_id=resources.id) "
+    "WHERE resources.path = ANY(:resources) AND role_id = ANY(:roles)"
+)
+
+user_resources_by_roles_query = text(
+    "select  distinct(resources.path), resources.description, resources.value from resource_roles "
+    "inner join resources on (resource_roles.resource_id=resources.id) "
+    "where resource_roles.role_id = ANY(:roles)"
+)
+
+
+def get_user_by_username(username):
+    """
+
+    :return: dict of id, service_name, roles and the stored password hash of the user, None if there is no such user.
+    """
+    tuple_result = db_wrapper.session.execute(user_by_username_query, {"username": username}).first()
     db_wrapper.session.commit()
     if tuple_result is None:
         return tuple_result
-    return {"id": tuple_result[0], "roles": tuple_result[1]}
+    return {"id": tuple_result[0], "service_name": tuple_result[1], "roles": tuple_result[2], "password": tuple_result[3]}
+
+
+def update_password(user_id, password_hash: str):
+    """Replaces the stored password hash of the user"""
+    db_wrapper.session.execute(Users.__table__.update().where(Users.id == user_id).values(password=password_hash))
+    db_wrapper.session.commit()
 
 
 def get_resources_by_roles(roles: set, resources: set) -> list:
@@ -124,25 +186,69 @@ def get_resources_by_roles(roles: set, resources: set) -> list:
         raise TypeError("empty roles")
     if len(resources) < 1:
         raise TypeError("empty resources")
-    result = db_wrapper.session.execute(
-        "SELECT DISTINCT resources.path, resources.value "
-        "FROM resource_roles INNER JOIN resources ON (resource_roles.resource_id=resources.id) "
-        "WHERE resources.path IN ({resources}) AND role_id IN ({roles})".format(
-            resources="'" + "','".join(resources) + "'",
-            roles=','.join(map(str, roles))
-        )
-    ).fetchall()
+    result = replicas.read(lambda session: session.execute(
+        resources_by_roles_query, {"resources": list(resources), "roles": list(roles)}
+    ).fetchall())
+    db_wrapper.session.commit()
+    return list(result)
+
+
+def get_role_resources_by_roles(roles: set, resources: set) -> list:
+    """Batch variant of get_resources_by_roles which keeps the granting role of each resource
+
+    :return: list of (role_id, resource path, resource value) rows for the provided roles and resources.
+    :raises TypeError: if either of roles or resources is empty.
+    """
+    if len(roles) < 1:
+        raise TypeError("empty roles")
+    if len(resources) < 1:
+        raise TypeError("empty resources")
+    result = replicas.read(lambda session: session.execute(
+        role_resources_by_roles_query, {"resources": list(resources), "roles": list(roles)}
+    ).fetchall())
     db_wrapper.session.commit()
     return list(result)
 
 
+@lru_cache(maxsize=None)
+def many_many_query(base: str, sub: str, relation: str, field_to_base: str, field_to_sub: str, fields: tuple,
+                    one: bool, after: bool=False, limit: bool=False):
+    """Returns the statement selecting the sub rows of a base row via the relation table, built once per arguments
+
+    the names come from the models, ids are bound on execution as :base_id and, if one is True, :sub_id.
+    if after or limit is True, the rows are ordered by id and :after or :limit are bound as well.
+    """
+    query = (
+        "select {fields} from {base} "
+        "inner join {relation} on ({base}.id={relation}.{field_to_base}) "
+        "inner join {sub} on ({sub}.id={relation}.{field_to_sub}) "
+        "WHERE {relation}.{field_to_base}=:base_id".format(
+            fields=sub + "." + ", {}.".format(sub).join(fields),
+            base=base,
+            sub=sub,
+            relation=relation,
+            field_to_base=field_to_base,
+            field_to_sub=field_to_sub
+        )
+    )
+    if one:
+        query += " AND {relation}.{field_to_sub}=:sub_id".format(relation=relation, field_to_sub=field_to_sub)
+    if after:
+        query += " AND {sub}.id > :after".format(sub=sub)
+    if after or limit:
+        query += " ORDER BY {sub}.id".format(sub=sub)
+    if limit:
+        query += " LIMIT :limit"
+    return text(query)
+
+
 def get_all_many_many_as_sub(
         base_model: db_wrapper.Model,
         sub_model: db_wrapper.Model,
         relation_table: db_wrapper.Table,
         relation_field_to_base: str,
         relation_field_to_sub: str,
-        base_id: str, fields: list):
+        base_id: str, fields: list, after=None, limit=None, stream=False):
     """Returns all instances of sub model connected to the base model via many-many relation.
     :param base_model: The source model of the many to many relationship.
     :param sub_model: the target model of the many to many relationship.
@@ -151,24 +257,21 @@ def get_all_many_many_as_sub(
     :param relation_field_to_sub: the foreign key from the relation table to the target(sub) table.
     :param base_id: the id of the base model instance.
     :param fields: list of field names of the target model to be fetched
+    :param after: if provided, only the instances with greater ids are returned, ordered by id.
+    :param limit: if provided, at most limit instances are returned, ordered by id.
+    :param stream: if True, the instances are yielded as they are read from a server side cursor.
     :return: instances of the sub model that has relationship with the source model instance.
     """
-    results = db_wrapper.session.execute(
-        "select {fields} from {base} "
-        "inner join {relation} on ({base}.id={relation}.{field_to_base}) "
-        "inner join {sub} on ({sub}.id={relation}.{field_to_sub}) WHERE {relation}.{field_to_base}={base_id}".format(
-            fields=sub_model.__table__.name + "." + ", {}.".format(sub_model.__table__.name).join(fields),
-            base=base_model.__table__.name,
-            sub=sub_model.__table__.name,
-            relation=relation_table.name,
-            field_to_base=relation_field_to_base,
-            field_to_sub=relation_field_to_sub,
-            base_id=base_id
-        )
+    query = many_many_query(
+        base_model.__table__.name, sub_model.__table__.name, relation_table.name,
+        relation_field_to_base, relation_field_to_sub, tuple(fields), one=False,
+        after=after is not None, limit=limit is not None
     )
+    params = {"base_id": base_id, "after": after, "limit": limit}
+    if stream:
+        return (sub_model(**dict(r)) for r in replicas.stream(query, params))
+    results = replicas.read(lambda session: session.execute(query, params).fetchall())
     db_wrapper.session.commit()
-    if results is None:
-        return []
     return [sub_model(**dict(r)) for r in results]
 
 
@@ -191,21 +294,11 @@ def get_one_many_many_as_sub(
     :param sub_id: the id of the sub model instance to be returned.
     :return: instance of the sub model that has relationship with the source model instance and match the provided id.
     """
-    result = db_wrapper.session.execute(
-        "select {fields} from {base} "
-        "inner join {relation} on ({base}.id={relation}.{field_to_base}) "
-        "inner join {sub} on ({sub}.id={relation}.{field_to_sub}) "
-        "WHERE {relation}.{field_to_base}={base_id} AND {relation}.{field_to_sub}={sub_id}".format(
-            fields=sub_model.__table__.name + "." + ", {}.".format(sub_model.__table__.name).join(fields),
-            base=base_model.__table__.name,
-            sub=sub_model.__table__.name,
-            relation=relation_table.name,
-            field_to_base=relation_field_to_base,
-            field_to_sub=relation_field_to_sub,
-            base_id=base_id,
-            sub_id=sub_id
-        )
-    ).first()
+    query = many_many_query(
+        base_model.__table__.name, sub_model.__table__.name, relation_table.name,
+        relation_field_to_base, relation_field_to_sub, tuple(fields), one=True
+    )
+    result = replicas.read(lambda session: session.execute(query, {"base_id": base_id, "sub_id": sub_id}).first())
     db_wrapper.session.commit()
     if result is None:
         return {}
@@ -215,13 +308,9 @@ def get_one_many_many_as_sub(
 def get_user_resources_by_roles(roles: list):
     if len(roles) < 1:
         raise TypeError("empty roles list")
-    results = db_wrapper.session.execute(
-        "select  distinct(resources.path), resources.description from resource_roles "
-        "inner join resources on (resource_roles.resource_id=resources.id) "
-        "where resource_roles.role_id in ({roles});".format(
-            roles=",".join(map(str, roles))
-        )
-    ).fetchall()
+    results = replicas.read(
+        lambda session: session.execute(user_resources_by_roles_query, {"roles": list(roles)}).fetchall()
+    )
     db_wrapper.session.commit()
     return [Resources(**r) for r in results]
 
@@ -258,22 +347,3 @@ def delete_from_relation_table(
         return True
     else:
         return False
-
-
-def get_resources_by_user_pass(username: str, password: str):
-    """
-
-    :param username: the username in query criteria.
-    :param password: the password in query criteria.
-    :return: set of Resource paths the user has access to.
-    """
-    results = db_wrapper.session.execute(
-        "select resources.path from users inner join user_roles on (users.id=user_roles.user_id) " 
-        "inner join resource_roles on (user_roles.role_id=resource_roles.role_id) " 
-        "inner join resources on (resources.id=resource_roles.resource_id) "
-        "where users.username='{username}' and password='{password}'".format(username=username, password=password)
-    )
-    db_wrapper.session.commit()
-    if not results:
-        return []
-    return {r[0] for r in results}
@@ -0,0 +1,234 @@
+import threading
+import time
+from logging import getLogger
+import redis
+from sqlalchemy.sql import select
+from auth_server import db_wrapper, policy_version, authorization_cache
+from auth_server.models.auth_model import Resources, resource_roles
+from auth_server.utils.wildcards import SEPARATOR, is_wildcard
+
+
+class _PrefixTrie:
+    """Trie of the wildcard resource paths by their ':' separated segments
+
+    the node reached by the segments of 'billing:invoices:*' holds the position of that resource as its grant.
+    """
+    __slots__ = ("children", "grant")
+
+    def __init__(self):
+        self.children = {}
+        self.grant = None
+
+    def insert(self, path: str, position: int):
+        node = self
+        for segment in path.split(SEPARATOR)[:-1]:
+            node = node.children.setdefault(segment, _PrefixTrie())
+        node.grant = position
+
+    def grants(self, path: str) -> list:
+        """Returns positions of the wildcard resources granting the path, the most specific first"""
+        result = []
+        node = self
+        # a wildcard stands for one segment at least, so the last segment of the path is never walked
+        for segment in path.split(SEPARATOR)[:-1]:
+            if node.grant is not None:
+                result.append(node.grant)
+            node = node.children.get(segment)
+            if node is None:
+                break
+        else:
+            if node.grant is not None:
+                result.append(node.grant)
+        result.reverse()
+        return result
+
+
+class _Snapshot:
+    """Immutable state of the index, swapped as a whole on rebuild"""
+    __slots__ = ("version", "built_at", "path_positions", "resources", "role_bits", "wildcards")
+
+    def __init__(self, version, path_positions: dict, resources: list, role_bits: dict, wildcards: _PrefixTrie):
+        self.version = version
+        self.built_at = time.monotonic()
+        # resource path -> position of the resource
+        self.path_positions = path_positions
+        # (path, value, description) of the resources by their position, which is their rank by id
+        self.resources = resources
+        # role id -> bitset of resource positions, bit n is set if the role has the resource at position n.
+        # positions are dense, so the bitsets stay as wide as the number of resources whatever their ids are
+        self.role_bits = role_bits
+        # wildcard resources, None if there is none
+        self.wildcards = wildcards
+
+    @classmethod
+    def build(cls, version, resource_rows, relation_rows) -> "_Snapshot":
+        """
+        :param resource_rows: (id, path, value, description) rows of resources.
+        :param relation_rows: (role_id, resource_id) rows of resource_roles.
+        """
+        path_positions = {}
+        resources = []
+        positions = {}
+        wildcards = None
+        for position, (id, path, value, description) in enumerate(sorted(resource_rows, key=lambda row: row[0])):
+            positions[id] = position
+            path_positions[path] = position
+            resources.append((path, value, description))
+            if is_wildcard(path):
+                if wildcards is None:
+                    wildcards = _PrefixTrie()
+                wildcards.insert(path, position)
+        role_bits = {}
+        for role_id, resource_id in relation_rows:
+            # a resource created between the two queries is left to the rebuild of its version
+            if resource_id in positions:
+                role_bits[role_id] = role_bits.get(role_id, 0) | (1 << positions[resource_id])
+        getLogger().info("policy index of {} resources and {} roles loaded at version {}".format(
+            len(resources), len(role_bits), version
+        ))
+        return cls(version, path_positions, resources, role_bits, wildcards)
+
+    def mask(self, roles) -> int:
+        mask = 0
+        for role in roles:
+            mask |= self.role_bits.get(role, 0)
+        return mask
+
+
+class PolicyIndex:
+    """In-memory index of roles, resources and resource_roles answering authorization queries without SQL.
+
+    The index is rebuilt when the policy version moves, which is checked at most every check_interval seconds,
+    and right after a change made by this worker. While the version cannot be read, the index is rebuilt
+    every fallback_interval seconds instead, as changes made meanwhile are not told by the version.
+    Unless self_refresh is set, that is left to the caller by due and load, e.g. by the asyncio mode.
+    """
+
+    resources_query = select([Resources.id, Resources.path, Resources.value, Resources.description])
+
+    relations_query = select([resource_roles.c.role_id, resource_roles.c.resource_id])
+
+    def __init__(self):
+        self.enabled = False
+        self.check_interval = 1
+        self.fallback_interval = 30
+        self.__snapshot = None
+        self.__stale = False
+        self.__checked_at = 0
+        self.__self_refresh = True
+        self.__lock = threading.Lock()
+
+    def configure(self, enabled: bool, check_interval: float, fallback_interval: float, self_refresh: bool=True):
+        self.enabled = enabled
+        self.check_interval = check_interval
+        self.fallback_interval = fallback_interval
+        self.__self_refresh = self_refresh
+        self.__snapshot = None
+
+    def sync(self):
+        """Rebuilds the index if the policy version moved, clearing authorization_cache with it"""
+        self.__current()
+
+    def invalidate(self):
+        """Rebuilds the index on its next use"""
+        self.__stale = True
+
+    def due(self) -> bool:
+        """Whether the policy version should be checked before the index answers"""
+        return (
+            self.__snapshot is None or self.__stale or time.monotonic() - self.__checked_at >= self.check_interval
+        )
+
+    def outdated(self, version) -> bool:
+        """Whether the index should be rebuilt for the policy version, None if the version is unknown"""
+        snapshot = self.__snapshot
+        if snapshot is None or self.__stale:
+            return True
+        if version is None:
+            return time.monotonic() - snapshot.built_at >= self.fallback_interval
+        return version != snapshot.version
+
+    def load(self, version, resource_rows=None, relation_rows=None):
+        """Rebuilds the index out of the rows of resources_query and relations_query, if it is outdated for version
+
+        without rows, only records that the version is checked.
+        """
+        if resource_rows is not None and self.outdated(version):
+            replaced = self.__snapshot is not None
+            self.__stale = False
+            self.__snapshot = _Snapshot.build(version, resource_rows, relation_rows)
+            if replaced:
+                authorization_cache.clear()
+        self.__checked_at = time.monotonic()
+
+    def __current(self) -> _Snapshot:
+        snapshot = self.__snapshot
+        if snapshot is not None and (not self.__self_refresh or not self.due()):
+            return snapshot
+        # while one thread refreshes, the others keep answering from the current snapshot
+        if not self.__lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            self.__refresh()
+        finally:
+            self.__lock.release()
+        return self.__snapshot
+
+    def __refresh(self):
+        try:
+            version = policy_version.current()
+        except redis.RedisError as e:
+            getLogger().warning("policy version is not available, the policy index is rebuilt periodically: {}".format(
+                e
+            ))
+            version = None
+        if not self.outdated(version):
+            self.load(version)
+            return
+        # read from the primary, a lagging replica would label an older graph by the new version
+        resource_rows = db_wrapper.session.execute(self.resources_query).fetchall()
+        relation_rows = db_wrapper.session.execute(self.relations_query).fetchall()
+        db_wrapper.session.commit()
+        self.load(version, resource_rows, relation_rows)
+
+    def version(self):
+        """Returns the policy version the index answers at, None if it is not known"""
+        return self.__current().version
+
+    def allowed(self, roles, paths) -> list:
+        """Index variant of get_resources_by_roles
+
+        :return: (path, value) tuples of the paths allowed by any of the roles,
+        either by their own resource or by the most specific wildcard resource granting them.
+        """
+        snapshot = self.__current()
+        mask = snapshot.mask(roles)
+        result = []
+        for path in paths:
+            position = snapshot.path_positions.get(path)
+            if position is not None and mask >> position & 1:
+                result.append((path, snapshot.resources[position][1]))
+            elif snapshot.wildcards is not None:
+                for grant in snapshot.wildcards.grants(path):
+                    if mask >> grant & 1:
+                        result.append((path, snapshot.resources[grant][1]))
+                        break
+        return result
+
+    def role_resources(self, roles) -> list:
+        """Index variant of get_user_resources_by_roles
+
+        :return: path, value and description dicts of all resources allowed by any of the roles, ordered by id.
+        """
+        snapshot = self.__current()
+        mask = snapshot.mask(roles)
+        result = []
+        while mask:
+            lowest = mask & -mask
+            path, value, description = snapshot.resources[lowest.bit_length() - 1]
+            result.append({"path": path, "value": value, "description": description})
+            mask ^= lowest
+        return result
+
+
+policy_index = PolicyIndex()
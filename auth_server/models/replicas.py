@@ -0,0 +1,122 @@
+import itertools
+import time
+from logging import getLogger
+from flask import Flask
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from auth_server import db_wrapper
+from auth_server.utils.metrics import operation
+
+WRITES = ("insert", "update", "delete")
+
+
+class Replicas:
+    """Read replicas of the database, the read only queries given to read or stream are spread over them round robin
+
+    a replica failing to connect or to run a query is skipped for retry_interval seconds, its queries are run by
+    the next one or by the primary if none is healthy. the reads of a worker go to the primary for sticky_seconds
+    after it writes to the primary, so the clients of the worker read their writes despite the replication lag,
+    and after it sees a new version of the data, so responses tagged by the version are not read from the past.
+    """
+
+    def __init__(self):
+        self.__engines = []
+        self.__sessions = []
+        self.__down_until = []
+        self.__turn = itertools.count()
+        self.__held_at = float("-inf")
+        self.__versions = {}
+        self.retry_interval = 5.0
+        self.sticky_seconds = 5.0
+
+    @property
+    def engines(self) -> list:
+        return list(self.__engines)
+
+    def init_app(self, app: Flask, primary: Engine):
+        """Connects to the REPLICA_DATABASE_URIS of the app and watches the writes of the primary engine"""
+        for engine in self.__engines:
+            engine.dispose()
+        self.__engines = [create_engine(uri, pool_pre_ping=True) for uri in app.config["REPLICA_DATABASE_URIS"]]
+        self.__sessions = [sessionmaker(bind=engine) for engine in self.__engines]
+        self.__down_until = [0.0] * len(self.__engines)
+        self.retry_interval = app.config["REPLICA_RETRY_INTERVAL"]
+        self.sticky_seconds = app.config["REPLICA_STICKY_SECONDS"]
+        if not event.contains(primary, "after_cursor_execute", self.after_cursor_execute):
+            event.listen(primary, "after_cursor_execute", self.after_cursor_execute)
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if operation(statement) in WRITES:
+            self.hold()
+
+    def hold(self):
+        """Sends the reads of the worker to the primary for the next sticky_seconds"""
+        self.__held_at = time.monotonic()
+
+    def saw_version(self, name: str, version):
+        """Holds the reads on the primary if the version named name moved since the worker saw it last"""
+        if self.__versions.get(name) != version:
+            self.__versions[name] = version
+            self.hold()
+
+    def __next(self):
+        """Returns the index of the next healthy replica, None if the reads should go to the primary"""
+        now = time.monotonic()
+        if not self.__engines or now - self.__held_at < self.sticky_seconds:
+            return None
+        for _ in range(len(self.__engines)):
+            index = next(self.__turn) % len(self.__engines)
+            if self.__down_until[index] <= now:
+                return index
+        return None
+
+    def __down(self, index: int, e: Exception):
+        getLogger().warning("replica {} is skipped for {} seconds: {}".format(
+            self.__engines[index].url.host, self.retry_interval, e
+        ))
+        self.__down_until[index] = time.monotonic() + self.retry_interval
+
+    def read(self, query):
+        """Returns query(session) run by a session of the next healthy replica
+
+        it is run by the primary session if there is none or the replica fails, the primary session is not
+        committed so the caller should commit it as it does for its other queries.
+        :param query: function of a session returning the rows it reads, it should not return lazy results.
+        """
+        index = self.__next()
+        if index is not None:
+            session = self.__sessions[index]()
+            try:
+                return query(session)
+            except OperationalError as e:
+                self.__down(index, e)
+            finally:
+                session.close()
+        return query(db_wrapper.session)
+
+    def stream(self, statement, params: dict=None):
+        """Yields the rows of the read only statement from a server side cursor of the next healthy replica
+
+        the primary session runs it if there is none or the replica cannot be connected to, a replica failing
+        after the rows started is not replaced.
+        """
+        index = self.__next()
+        if index is not None:
+            try:
+                connection = self.__engines[index].connect()
+            except OperationalError as e:
+                self.__down(index, e)
+            else:
+                with connection:
+                    yield from connection.execution_options(stream_results=True).execute(statement, params or {})
+                return
+        try:
+            for row in db_wrapper.session.execute(statement.execution_options(stream_results=True), params):
+                yield row
+        finally:
+            db_wrapper.session.commit()
+
+
+replicas = Replicas()
@@ -1,11 +1,18 @@
 from logging import getLogger
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import inspect
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import select
 from auth_server import db_wrapper
-from auth_server.models.errors import DoesNotExist, DuplicateConstraint
+from auth_server.models.errors import DoesNotExist, DuplicateConstraint, ConstraintViolation
+from auth_server.models.replicas import replicas
 
 
 class CrudModel:
-    """Mixin to be used with FlaskSqlAlchemy model class to add CRUD operations"""
+    """Mixin to be used with FlaskSqlAlchemy model class to add CRUD operations
+
+    the listings are read from the replicas, if any, single records from the primary.
+    """
     @classmethod
     def get_by_id(cls, id):
         """get a row by id
@@ -20,7 +27,27 @@ class CrudModel:
     @classmethod
     def get_all(cls):
         """get all rows"""
-        return cls.query.all()
+        return replicas.read(lambda session: session.query(cls).all())
+
+    @classmethod
+    def get_page(cls, after=None, limit=None):
+        """get rows ordered by id, the ones with id greater than after if it is provided, at most limit rows"""
+        def query(session):
+            rows = session.query(cls)
+            if after is not None:
+                rows = rows.filter(cls.id > after)
+            return rows.order_by(cls.id).limit(limit).all()
+        return replicas.read(query)
+
+    @classmethod
+    def stream(cls, after=None, limit=None):
+        """Like get_page but yields plain rows from a server side cursor, so memory stays flat"""
+        # deferred columns are left out, as they are by the queries of the model
+        columns = [attr.columns[0] for attr in inspect(cls).column_attrs if not attr.deferred]
+        query = select(columns).order_by(cls.id).limit(limit)
+        if after is not None:
+            query = query.where(cls.id > after)
+        return replicas.stream(query)
 
     @classmethod
     def create(cls, data: dict):
@@ -38,6 +65,43 @@ class CrudModel:
             raise e
         return instance.id
 
+    @classmethod
+    def create_many(cls, items: list, chunk_size: int) -> list:
+        """Inserts the records by a multi-row insert per chunk, skipping the ones violating unique constraints
+
+        the records are committed at once, after all chunks. the model should have unique columns, they tell
+        which records are inserted.
+        :return: the id of each inserted record, None for the duplicates, in the same order as items.
+        :raises ConstraintViolation: in case of any other constraint violation, nothing is inserted then.
+        """
+        table = cls.__table__
+        unique = [c for c in table.columns if c.unique]
+        columns = set()
+        for item in items:
+            columns.update(item)
+        ids = [None] * len(items)
+        try:
+            for start in range(0, len(items), chunk_size):
+                chunk = items[start:start + chunk_size]
+                # all rows of a multi-row insert should have the same columns
+                rows = [{c: item.get(c) for c in columns} for item in chunk]
+                inserted = db_wrapper.session.execute(
+                    insert(table).values(rows).on_conflict_do_nothing().returning(table.c.id, *unique)
+                ).fetchall()
+                # the first item of a unique key in the chunk is the inserted one, the rest are duplicates
+                inserted_ids = {tuple(row[1:]): row[0] for row in inserted}
+                for i, item in enumerate(chunk, start):
+                    ids[i] = inserted_ids.pop(tuple(item.get(c.name) for c in unique), None)
+            db_wrapper.session.commit()
+        except IntegrityError as e:
+            getLogger().exception(e)
+            db_wrapper.session.rollback()
+            raise ConstraintViolation
+        except Exception as e:
+            db_wrapper.session.rollback()
+            raise e
+        return ids
+
     @classmethod
     def update(cls, id, data: dict):
         """Update a record partially
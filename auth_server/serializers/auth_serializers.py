@@ -18,6 +18,9 @@ class Claims(Schema):
 
     roles = fields.List(fields.Int(), required=True)
     iss_dt = fields.DateTime(required=True)
+    # only in tokens embedding their resources, resource path and value pairs like AuthorizeOutput resources
+    resources = fields.Dict(values=fields.Field(), keys=fields.Str())
+    policy_version = fields.Int()
 
     @pre_dump
     def convert_none_to_empty(self, data):
@@ -29,6 +32,10 @@ class Claims(Schema):
         return data
 
 
+class PolicyVersionOutput(Schema):
+    policy_version = fields.Int(dump_only=True)
+
+
 class AuthorizeInput(StrictSchema):
     token = fields.Str(required=True, load_only=True)
     resources = fields.List(fields.Str(), required=True, load_only=True)
@@ -37,3 +44,10 @@ class AuthorizeInput(StrictSchema):
 class AuthorizeOutput(Schema):
     token = fields.Str(required=True)
     resources = fields.Dict(values=fields.Field(), keys=fields.Str())
+
+
+class BatchAuthorizeOutput(Schema):
+    token = fields.Str(required=True)
+    resources = fields.Dict(values=fields.Field(), keys=fields.Str())
+    error = fields.Str()
+    status = fields.Int()
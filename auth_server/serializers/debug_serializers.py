@@ -0,0 +1,16 @@
+from marshmallow import fields, Schema
+
+
+class AllocationStat(Schema):
+    traceback = fields.List(fields.Str())
+    size = fields.Int()
+    size_diff = fields.Int()
+    count = fields.Int()
+    count_diff = fields.Int()
+
+
+class TracemallocOutput(Schema):
+    pid = fields.Int()
+    traced_size = fields.Int()
+    peak_size = fields.Int()
+    stats = fields.Nested(AllocationStat, many=True)
@@ -1,5 +1,21 @@
-from marshmallow import Schema, fields, validate, post_load
-from auth_server.utils.password import hash_password
+import base64
+import binascii
+from marshmallow import Schema, fields, validate, post_load, ValidationError
+from auth_server.utils.password import password_hasher
+
+# image types an avatar may have, the avatar endpoints serve it by its type so nothing else is let in
+AVATAR_MIMETYPES = ("image/png", "image/jpeg", "image/gif", "image/webp")
+
+
+def validate_avatar(avatar: str):
+    """Accepts only base64 data URIs of the AVATAR_MIMETYPES, e.g. 'data:image/png;base64,iVBORw0...'"""
+    meta, _, data = avatar.partition(",")
+    if meta not in ["data:{};base64".format(mimetype) for mimetype in AVATAR_MIMETYPES]:
+        raise ValidationError("avatar should be a base64 data URI of one of {}".format(", ".join(AVATAR_MIMETYPES)))
+    try:
+        base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValidationError("avatar is not valid base64")
 
 
 class IdSerializer(Schema):
@@ -10,19 +26,30 @@ class UserSerializer(Schema):
     id = fields.Int(dump_only=True)
     username = fields.Str(validate=validate.Length(max=128, min=1), required=True)
     password = fields.Str(validate=validate.Length(max=256, min=8), load_only=True, required=True)
-    avatar = fields.Str(validate=validate.Length(max=10*1024))
+    # served by the avatar endpoints, avatar_hash tells whether it changed
+    avatar = fields.Str(validate=[validate.Length(max=10*1024), validate_avatar], load_only=True)
+    avatar_hash = fields.Str(dump_only=True)
     display_name = fields.Str(validate=validate.Length(max=128))
     service_name = fields.Str(validate=validate.Length(max=128))
 
-    @post_load
-    def hash_password(self, data):
-        try:
-            data["password"] = hash_password(data["password"])
-        except KeyError:
-            pass
+    @post_load(pass_many=True)
+    def hash_password(self, data, many):
+        items = data if many else [data]
+        with_password = [item for item in items if "password" in item]
+        if with_password:
+            for item, password in zip(
+                    with_password, password_hasher.hash_many([item["password"] for item in with_password])
+            ):
+                item["password"] = password
         return data
 
 
+class BulkCreateOutput(Schema):
+    id = fields.Int()
+    status = fields.Int(required=True)
+    error = fields.Str()
+
+
 class RoleSerializer(Schema):
     id = fields.Int(dump_only=True)
     name = fields.Str(validate=validate.Length(max=256), required=True)
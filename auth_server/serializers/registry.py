@@ -0,0 +1,131 @@
+from collections.abc import Mapping
+from functools import lru_cache
+from marshmallow import Schema, fields, missing
+from marshmallow.decorators import PRE_DUMP, POST_DUMP
+from marshmallow.utils import ensure_text_type
+from auth_server.utils import fast_json
+from auth_server.utils.metrics import serialization_seconds
+
+
+@lru_cache(maxsize=None)
+def schema(schema_class, **options) -> Schema:
+    """Returns the shared instance of the schema class created by the options
+
+    a schema keeps no state of its loads and dumps, so the hot endpoints share one
+    instead of deep copying the declared fields of a new one on every request.
+    options should be hashable, e.g. exclude=("id", ).
+    """
+    return schema_class(**options)
+
+
+def dumps(schema_class, obj, many: bool=None, **options) -> str:
+    """Same as schema(schema_class, **options).dumps(obj, many), by its compiled dumper and rapidjson"""
+    dumper = _dumper(schema_class, **options)
+    with dumper.seconds.time():
+        return fast_json.dumps(dumper.dump(obj, many))
+
+
+@lru_cache(maxsize=None)
+def _dumper(schema_class, **options) -> "_Dumper":
+    return _Dumper(schema(schema_class, **options))
+
+
+def _raw(value):
+    return value
+
+
+def _text(value):
+    if type(value) is str or value is None:
+        return value
+    return ensure_text_type(value)
+
+
+def _integer(value):
+    if value is None:
+        return None
+    if value is True or value is False:
+        raise TypeError("value must be a Number, not a boolean")
+    return int(value)
+
+
+def _field_serializer(field: fields.Field):
+    """Returns the function serializing values like field._serialize, None for the fields it does not support"""
+    if field.default is not missing or getattr(field, "attribute", None) is not None:
+        return None
+    field_type = type(field)
+    if field_type is fields.Field:
+        return _raw
+    if field_type is fields.String:
+        return _text
+    if field_type is fields.Integer and not field.as_string and not field.strict:
+        return _integer
+    if field_type is fields.Dict:
+        if field.key_container is None and field.value_container is None:
+            return _raw
+        serialize_key = _raw if field.key_container is None else _field_serializer(field.key_container)
+        serialize_value = _raw if field.value_container is None else _field_serializer(field.value_container)
+        if serialize_key is None or serialize_value is None:
+            return None
+
+        def serialize(value):
+            if value is None:
+                return None
+            if not isinstance(value, Mapping):
+                raise TypeError("value is not a mapping")
+            return {serialize_key(k): serialize_value(v) for k, v in value.items()}
+        return serialize
+    return None
+
+
+class _Dumper:
+    """Dumps mappings like the schema does, by a serializer per field compiled out of the schema
+
+    schemas with hooks, custom accessors or other fields than Str, Int, Dict and Field are dumped by the schema,
+    so are the objects that are not mappings or fail to serialize, which gets the errors of the schema.
+    """
+
+    def __init__(self, schema_obj: Schema):
+        self.schema = schema_obj
+        self.fields = self.__compile(schema_obj)
+        self.seconds = serialization_seconds.labels(type(schema_obj).__name__)
+
+    @staticmethod
+    def __compile(schema_obj: Schema):
+        if (
+                schema_obj._has_processors(PRE_DUMP) or schema_obj._has_processors(POST_DUMP) or
+                schema_obj.prefix or schema_obj.ordered or
+                type(schema_obj).get_attribute is not Schema.get_attribute
+        ):
+            return None
+        compiled = []
+        for attr_name, field in schema_obj.fields.items():
+            if field.load_only:
+                continue
+            serialize = _field_serializer(field)
+            if serialize is None or "." in attr_name:
+                return None
+            compiled.append((attr_name, field.data_key or attr_name, serialize))
+        return compiled
+
+    def __dump_one(self, obj) -> dict:
+        if type(obj) is not dict and not isinstance(obj, Mapping):
+            raise TypeError("object is not a mapping")
+        result = {}
+        for attr_name, key, serialize in self.fields:
+            try:
+                value = obj[attr_name]
+            except KeyError:
+                continue
+            result[key] = serialize(value)
+        return result
+
+    def dump(self, obj, many: bool=None):
+        many = self.schema.many if many is None else many
+        if many and not isinstance(obj, (list, tuple)):
+            obj = list(obj)
+        if self.fields is not None:
+            try:
+                return [self.__dump_one(item) for item in obj] if many else self.__dump_one(obj)
+            except (TypeError, ValueError, AttributeError):
+                pass
+        return self.schema.dump(obj, many=many)
@@ -1,8 +1,12 @@
 from logging import getLogger
+from auth_server import authorization_cache
 from auth_server.models import auth_model
-from auth_server.models.auth_model import get_resources_by_roles
+from auth_server.models.auth_model import get_resources_by_roles, get_role_resources_by_roles, \
+    get_user_resources_by_roles
+from auth_server.models.policy_index import policy_index
 from auth_server.user_manager.abc_user_manager import BaseUserManager
-from auth_server.utils.password import hash_password
+from auth_server.utils.password import password_hasher
+from auth_server.utils.wildcards import expand_paths, match_grants
 
 
 class LocalUserManager(BaseUserManager):
@@ -13,33 +17,154 @@ class LocalUserManager(BaseUserManager):
             self.password = kwargs["password"]
         except KeyError:
             raise TypeError("missing argument 'password'")
-        else:
-            self.password = hash_password(self.password)  # todo rainbow attack
 
     def register(self):
         raise NotImplementedError
 
     def authenticate(self) -> dict:
-        """
+        """Verifies the password against the stored hash
 
+        passwords stored by an older hasher or parameters are rehashed by the configured one.
         :return: user from database or None if authentication fails
+        :raises HashingBusy: if no password hashing worker got free in time.
+        """
+        user = auth_model.get_user_by_username(self.username)
+        if user is None:
+            # as slow as a wrong password, so usernames cannot be enumerated by the response time
+            password_hasher.verify_missing(self.password)
+            return None
+        matches, new_hash = password_hasher.verify(self.password, user.pop("password"))
+        if not matches:
+            return None
+        if new_hash is not None:
+            auth_model.update_password(user["id"], new_hash)
+            getLogger().info("password of user {} rehashed".format(self.username))
+        return user
+
+    @staticmethod
+    def user_resources(roles: list) -> list:
+        """Returns path, value and description dicts of all resources allowed by the roles
+
+        answered by policy_index if it is enabled, by the database otherwise.
+        :raises TypeError: if roles is empty.
         """
-        return auth_model.get_user_by_user_pass(self.username, self.password)
+        if len(roles) < 1:
+            raise TypeError("empty roles list")
+        if policy_index.enabled:
+            return policy_index.role_resources(roles)
+        return [
+            {"path": r.path, "value": r.value, "description": r.description} for r in get_user_resources_by_roles(roles)
+        ]
+
+    @staticmethod
+    def resources_of(roles: list) -> dict:
+        """Returns all resources allowed by the roles as a dict of resource path/value, True if the value is null"""
+        roles = [r for r in roles if r is not None]
+        try:
+            resources = LocalUserManager.user_resources(roles)
+        except TypeError:
+            return {}
+        return {r["path"]: True if r["value"] is None else r["value"] for r in resources}
 
     @staticmethod
     def authorize(roles: list, resources: list) -> dict:
-        """Gets resources and role identifiers and returns a dict of resources/allow(bool) pair"""
+        """Gets resources and role identifiers and returns a dict of resources/allow(bool) pair
+
+        decisions are memoized per worker in authorization_cache, keyed on the role and resource sets,
+        and resolved by policy_index if it is enabled, by the database otherwise. a decision is not cached
+        if the cache is cleared by a policy change while it is resolved, as it may be of the old policy.
+        a resource is allowed if one of the roles has it or a wildcard resource like 'billing:*' covering it.
+        """
+        if policy_index.enabled:
+            policy_index.sync()
+        generation = authorization_cache.generation
         all_resources = set(resources)
+        cache_key = (frozenset(roles), frozenset(all_resources))
+        cached = authorization_cache.get(cache_key)
+        if cached is not None:
+            return dict(cached)
         try:
-            resource_value_list = get_resources_by_roles(roles=set(roles), resources=all_resources)
+            if policy_index.enabled:
+                resource_value_list = policy_index.allowed(roles=set(roles), paths=all_resources)
+            else:
+                resource_value_list = match_grants(
+                    all_resources, dict(get_resources_by_roles(roles=set(roles), resources=expand_paths(all_resources)))
+                )
         except TypeError as e:
             getLogger().exception(e)
             getLogger().info("roles or resources empty, no resource allowed")
             resource_value_list = []
+        result = LocalUserManager._decisions(all_resources, resource_value_list)
+        authorization_cache.set(cache_key, result, generation=generation)
+        return dict(result)
+
+    @staticmethod
+    def authorize_many(requests: list) -> list:
+        """Batch variant of authorize
+
+        :param requests: list of (roles, resources) pairs.
+        :return: the resources/allow dict of each pair, in the same order as requests.
+        the pairs missing from authorization_cache are resolved by policy_index if it is enabled,
+        otherwise all of them by a single query.
+        """
+        if policy_index.enabled:
+            policy_index.sync()
+        generation = authorization_cache.generation
+        results = [None] * len(requests)
+        missed = []
+        for i, (roles, resources) in enumerate(requests):
+            cached = authorization_cache.get((frozenset(roles), frozenset(resources)))
+            if cached is None:
+                missed.append(i)
+            else:
+                results[i] = dict(cached)
+        if not missed:
+            return results
+
+        if policy_index.enabled:
+            for i in missed:
+                roles, resources = requests[i]
+                resources = set(resources)
+                result = LocalUserManager._decisions(resources, policy_index.allowed(roles=set(roles), paths=resources))
+                authorization_cache.set((frozenset(roles), frozenset(resources)), result, generation=generation)
+                results[i] = dict(result)
+            return results
+
+        all_roles = set()
+        all_resources = set()
+        for i in missed:
+            all_roles.update(requests[i][0])
+            all_resources.update(requests[i][1])
+        try:
+            rows = get_role_resources_by_roles(roles=all_roles, resources=expand_paths(all_resources))
+        except TypeError:
+            getLogger().info("roles or resources of the whole batch empty, no resource allowed")
+            rows = []
+        # role id -> {resource path: resource value} of granted resources
+        grants = {}
+        for role_id, path, value in rows:
+            grants.setdefault(role_id, {})[path] = value
+
+        for i in missed:
+            roles, resources = requests[i]
+            resources = set(resources)
+            granted = {}
+            for role in set(roles):
+                granted.update(grants.get(role, {}))
+            resource_value_list = match_grants(resources, granted)
+            result = LocalUserManager._decisions(resources, resource_value_list)
+            authorization_cache.set((frozenset(roles), frozenset(resources)), result, generation=generation)
+            results[i] = dict(result)
+        return results
+
+    @staticmethod
+    def _decisions(resources: set, resource_value_list) -> dict:
+        """Builds the resources/allow dict out of the requested resources and the allowed (resource, value) tuples"""
+        not_allowed = set(resources)
         # iterate over allowed resources which is a list of tuples(resource, value)
         result = {}
         for r, v in resource_value_list:
             result[r] = True if v is None else v
-            all_resources.remove(r)
-        result.update({r: False for r in all_resources})
+            not_allowed.discard(r)
+        result.update({r: False for r in not_allowed})
         return result
@@ -1,46 +1,185 @@
 import datetime
+import os
+import threading
+from logging import getLogger
 import redis
-from flask import current_app
+from flask import Flask
 import time
+from auth_server.utils.bloom import BloomFilter
+from auth_server.utils.metrics import redis_command_seconds
+
+
+def run_periodically(fn, interval: float, name: str):
+    """Calls fn every interval seconds in a daemon thread, redis errors are logged and retried on the next call"""
+    def run():
+        while True:
+            try:
+                fn()
+            except redis.RedisError as e:
+                getLogger().warning("{} failed: {}".format(name, e))
+            time.sleep(interval)
+    threading.Thread(target=run, name=name, daemon=True).start()
+
+
+class BlacklistMirror:
+    """Per worker mirror of the revoked tokens set, kept in a bloom filter.
+
+    A background thread pulls the tokens revoked since its last sync out of the redis sorted set, using
+    their revocation time as cursor. A token missing from the filter is surely not revoked, up to the sync interval,
+    any other token should be checked in redis. If syncing stalls the mirror stops answering.
+    """
+    # seconds re-read before the cursor on every sync, tolerates clock skew between revoking workers
+    __overlap = 10
+    __error_rate = 0.001
+
+    def __init__(self, redis_client: redis.StrictRedis, blacklist: str, login_exp: datetime.timedelta,
+                 interval: float, capacity: int):
+        self.__redis = redis_client
+        self.__redis_blacklist = blacklist
+        self.__login_exp = login_exp
+        self.__interval = interval
+        self.__capacity = capacity
+        self.__bloom = None
+        self.__cursor = 0
+        self.__synced_at = 0
+
+    def start(self):
+        run_periodically(self.sync, self.__interval, "blacklist-mirror")
+
+    def sync(self):
+        """Pulls the newly revoked tokens, reloads the whole set once the filter is over its capacity"""
+        live_from = time.time() - self.__login_exp.total_seconds()
+        if self.__bloom is None or self.__bloom.count > self.__bloom.capacity:
+            entries = self.__redis.zrangebyscore(self.__redis_blacklist, live_from, '+inf', withscores=True)
+            bloom = BloomFilter(max(self.__capacity, 2 * len(entries)), self.__error_rate)
+            for token, _ in entries:
+                bloom.add(token.decode("utf-8"))
+            self.__bloom = bloom
+        else:
+            entries = self.__redis.zrangebyscore(
+                self.__redis_blacklist, max(live_from, self.__cursor - self.__overlap), '+inf', withscores=True
+            )
+            for token, _ in entries:
+                self.__bloom.add(token.decode("utf-8"))
+        self.__cursor = max([self.__cursor, live_from] + [score for _, score in entries])
+        self.__synced_at = time.monotonic()
+
+    def add(self, token: str):
+        if self.__bloom is not None:
+            self.__bloom.add(token)
+
+    def may_contain(self, token: str) -> bool:
+        """
+
+        :returns bool: False only if the token is surely not revoked, True if it should be checked in redis.
+        """
+        if self.__bloom is None or time.monotonic() - self.__synced_at > 3 * self.__interval:
+            return True
+        return token in self.__bloom
 
 
 class UserBlackList:
+    """Process wide blacklist of revoked tokens, backed by a redis sorted set scored by revocation time.
+
+    Expired tokens are pruned by a background sweeper, so checks are a single ZSCORE.
+    """
     __epoch = datetime.datetime(1970, 1, 1)
 
     def __init__(self):
-        self.__login_exp = current_app.config["JWT_ACCESS_TOKEN_EXPIRES"]
-        self.__redis_blacklist = current_app.config["REDIS_BLACKLIST"]
-        self.__redis = redis.StrictRedis(
-            host=current_app.config['REDIS_HOST'],
-            port=current_app.config['REDIS_PORT']
-        )
+        self.__redis = None
+        self.__mirror = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def init_app(self, app: Flask, redis_client: redis.StrictRedis):
+        """
+
+        :param redis_client: the client of the process wide connection pool.
+        """
+        self.__login_exp = app.config["JWT_ACCESS_TOKEN_EXPIRES"]
+        self.__redis_blacklist = app.config["REDIS_BLACKLIST"]
+        self.__sweep_interval = app.config["REDIS_BLACKLIST_SWEEP_INTERVAL"]
+        self.__redis = redis_client
+        if app.config["REDIS_BLACKLIST_MIRROR"]:
+            self.__mirror = BlacklistMirror(
+                self.__redis,
+                blacklist=self.__redis_blacklist,
+                login_exp=self.__login_exp,
+                interval=app.config["REDIS_BLACKLIST_MIRROR_INTERVAL"],
+                capacity=app.config["REDIS_BLACKLIST_MIRROR_CAPACITY"]
+            )
+        else:
+            self.__mirror = None
+        self.__pid = None
 
     @classmethod
     def __sec_from_epoch(cls, dt: datetime.datetime) -> float:
         return (dt - cls.__epoch).total_seconds()
 
+    def __start_background_threads(self):
+        """Starts the sweeper and the mirror once per process, threads do not survive forking workers"""
+        if self.__pid == os.getpid():
+            return
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+            run_periodically(self.sweep, self.__sweep_interval, "blacklist-sweeper")
+            if self.__mirror is not None:
+                self.__mirror.start()
+            self.__pid = os.getpid()
+
+    def sweep(self):
+        """Removes the tokens that are expired anyway from blacklist"""
+        with redis_command_seconds.labels("zremrangebyscore").time():
+            self.__redis.zremrangebyscore(
+                self.__redis_blacklist, '-inf',
+                self.__sec_from_epoch(datetime.datetime.utcnow() - self.__login_exp)
+            )
+
     def persist_token_in_blacklist(self, token):
-        pipeline = self.__redis.pipeline()
-        pipeline.zremrangebyscore(
-            self.__redis_blacklist, '-inf',
-            self.__sec_from_epoch(datetime.datetime.utcnow() - self.__login_exp)
-        )
-        pipeline.zadd(self.__redis_blacklist, time.time(), token)
-        pipeline.execute()
+        self.__start_background_threads()
+        with redis_command_seconds.labels("zadd").time():
+            self.__redis.zadd(self.__redis_blacklist, time.time(), token)
+        if self.__mirror is not None:
+            self.__mirror.add(token)
+
+    @property
+    def key(self) -> str:
+        """The redis sorted set of revoked tokens, scored by revocation time"""
+        return self.__redis_blacklist
+
+    def may_contain(self, token) -> bool:
+        """Checks the token against the mirror, if enabled
+
+        :returns bool: False if the token is surely not in blacklist, True if redis should be asked
+        """
+        self.__start_background_threads()
+        return self.__mirror is None or self.__mirror.may_contain(token)
 
     def token_in_blacklist(self, token) -> bool:
         """Checks if token in blacklist
 
         :returns bool: True if token in blacklist and False otherwise
         """
-        pipeline = self.__redis.pipeline()
-        pipeline.zremrangebyscore(
-            self.__redis_blacklist, '-inf',
-            self.__sec_from_epoch(datetime.datetime.utcnow() - self.__login_exp)
-        )
-        pipeline.zscore(self.__redis_blacklist, token)
-        result = pipeline.execute()
-        if result[1] is None:
+        if not self.may_contain(token):
             return False
-        else:
-            return True
+        with redis_command_seconds.labels("zscore").time():
+            return self.__redis.zscore(self.__redis_blacklist, token) is not None
+
+    def tokens_in_blacklist(self, tokens: list) -> list:
+        """Batch variant of token_in_blacklist, checks all tokens in a single redis round trip
+
+        :returns list: a bool per token, True if the token is in blacklist and False otherwise
+        """
+        result = [False] * len(tokens)
+        to_check = [i for i, token in enumerate(tokens) if self.may_contain(token)]
+        if not to_check:
+            return result
+        pipeline = self.__redis.pipeline(transaction=False)
+        for i in to_check:
+            pipeline.zscore(self.__redis_blacklist, tokens[i])
+        with redis_command_seconds.labels("zscore_pipeline").time():
+            scores = pipeline.execute()
+        for i, score in zip(to_check, scores):
+            result[i] = score is not None
+        return result
@@ -0,0 +1,46 @@
+import hashlib
+import math
+import threading
+
+
+class BloomFilter:
+    """Probabilistic set of strings, membership tests may give false positives but never false negatives"""
+
+    def __init__(self, capacity: int, error_rate: float=0.001):
+        """
+
+        :param capacity: number of items the filter holds before its false positive rate exceeds error_rate.
+        :param error_rate: the false positive rate at capacity.
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self.__bits = bytearray((self.size + 7) // 8)
+        self.__lock = threading.Lock()
+
+    def __positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item: str) -> bool:
+        """Adds the item to the filter
+
+        :returns bool: True if the item was not in the filter before.
+        """
+        positions = self.__positions(item)
+        with self.__lock:
+            new = False
+            for p in positions:
+                if not self.__bits[p >> 3] & (1 << (p & 7)):
+                    new = True
+                    self.__bits[p >> 3] |= 1 << (p & 7)
+            if new:
+                self.count += 1
+        return new
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.__bits[p >> 3] & (1 << (p & 7)) for p in self.__positions(item))
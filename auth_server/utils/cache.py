@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+from auth_server.utils.metrics import cache_lookups
+
+
+class TTLCache:
+    """Bounded in-process cache with least recently used and time to live eviction.
+
+    Each worker process keeps its own instance, nothing is shared between processes.
+    A maxsize or ttl of zero disables the cache. Every clear starts a new generation, a value computed from
+    the state before a clear is not stored if it is set with the generation read before computing it.
+    """
+
+    def __init__(self, name: str, maxsize: int=1024, ttl: float=60):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__hit_counter = cache_lookups.labels(name, "hit")
+        self.__miss_counter = cache_lookups.labels(name, "miss")
+        self.__data = OrderedDict()
+        self.__generation = 0
+        self.__lock = threading.Lock()
+
+    def configure(self, maxsize: int, ttl: float):
+        """Resizes the cache and drops all of its entries"""
+        with self.__lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self.__data.clear()
+            self.__generation += 1
+
+    @property
+    def generation(self) -> int:
+        """Number of clears so far"""
+        return self.__generation
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key, default=None):
+        """Returns the value of the key or default if it is missing or expired"""
+        with self.__lock:
+            try:
+                expires_at, value = self.__data[key]
+            except KeyError:
+                self.misses += 1
+                self.__miss_counter.inc()
+                return default
+            if expires_at <= time.monotonic():
+                del self.__data[key]
+                self.misses += 1
+                self.__miss_counter.inc()
+                return default
+            self.__data.move_to_end(key)
+            self.hits += 1
+            self.__hit_counter.inc()
+            return value
+
+    def set(self, key, value, ttl: float=None, generation: int=None):
+        """Stores the value, evicting the least recently used entry if the cache is full
+
+        :param ttl: seconds the entry lives if shorter than the cache ttl.
+        :param generation: the generation read before computing the value, it is not stored if the cache is
+        cleared since.
+        """
+        if not self.enabled:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self.__lock:
+            if generation is not None and generation != self.__generation:
+                return
+            self.__data[key] = (time.monotonic() + ttl, value)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+            self.__generation += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self.__data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def __len__(self):
+        return len(self.__data)
@@ -0,0 +1,55 @@
+import gzip
+import zlib
+from flask import request, current_app, Response
+
+# besides text/*, the views return their json as text/html
+COMPRESSIBLE = {"application/json", "application/x-ndjson"}
+
+
+def compressible(mimetype: str) -> bool:
+    return mimetype in COMPRESSIBLE or mimetype.startswith("text/")
+
+
+def accepts_gzip() -> bool:
+    return request.accept_encodings["gzip"] > 0
+
+
+def gzip_stream(chunks, level: int):
+    """Compresses a streamed body as its chunks are produced"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_response(response: Response) -> Response:
+    """Gzips text and json responses of at least GZIP_MIN_SIZE bytes if the client accepts it, streams always
+
+    registered as an after_request function.
+    """
+    if response.status_code == 304:
+        response.vary.add("Accept-Encoding")
+    if not compressible(response.mimetype) or response.status_code != 200:
+        return response
+    response.vary.add("Accept-Encoding")
+    if "Content-Encoding" in response.headers or not accepts_gzip():
+        return response
+    level = current_app.config["GZIP_LEVEL"]
+    if response.is_streamed:
+        response.response = gzip_stream(response.response, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config["GZIP_MIN_SIZE"]:
+            return response
+        response.set_data(gzip.compress(data, level))
+    response.headers["Content-Encoding"] = "gzip"
+    # a strong tag would claim the compressed bytes equal the uncompressed ones
+    tag, weak = response.get_etag()
+    if tag is not None and not weak:
+        response.set_etag(tag, weak=True)
+    return response
@@ -0,0 +1,22 @@
+import json
+import rapidjson
+
+
+def dumps(obj) -> str:
+    """Encodes the serialized data by rapidjson, compact and ascii only like json.dumps with the default options"""
+    return rapidjson.dumps(obj)
+
+
+def loads(data):
+    """Decodes the document by rapidjson, whatever it rejects is left to json
+
+    so the accepted documents and their errors stay those of json, e.g. BOMs, lone surrogates or numbers out of range.
+    :param data: str or utf-8 bytes.
+    :raises ValueError: if the document is not valid json.
+    """
+    try:
+        return rapidjson.loads(data)
+    except ValueError:
+        if isinstance(data, bytes):
+            data = data.decode(json.detect_encoding(data), "surrogatepass")
+        return json.loads(data)
@@ -1,18 +1,26 @@
+import uuid
 from functools import wraps
 from logging import getLogger
-from flask import jsonify
-from flask_jwt_extended import verify_jwt_in_request, get_jwt_claims, get_raw_jwt
-from auth_server import jwt
+import jwt as pyjwt
+from flask import jsonify, request, _app_ctx_stack
+from flask_jwt_extended import get_jwt_claims, get_raw_jwt
+from flask_jwt_extended.config import config
+from flask_jwt_extended.exceptions import NoAuthorizationError, InvalidHeaderError
+from flask_jwt_extended.tokens import decode_jwt
+from flask_jwt_extended.utils import verify_token_claims, verify_token_type, verify_token_not_blacklisted
+from auth_server import jwt, blacklist, jwt_cache, key_ring
 from datetime import datetime
+import time
 from auth_server.serializers.auth_serializers import Claims
+from auth_server.serializers.registry import schema
+from auth_server.utils.metrics import jwt_decode_seconds
 from auth_server.user_manager.local_user_manager import LocalUserManager
-from auth_server.utils.blacklist import UserBlackList
 
 
 @jwt.user_claims_loader
 def add_claims_to_access_token(user, *args, **kwargs):
     user["iss_dt"] = datetime.utcnow()
-    return Claims().dump(user)
+    return schema(Claims).dump(user)
 
 
 @jwt.user_identity_loader
@@ -31,10 +39,104 @@ def invalid_token(e):
 @jwt.token_in_blacklist_loader
 def check_if_token_in_blacklist(decrypted_token):
     jti = decrypted_token['jti']
-    blacklist = UserBlackList()
     return blacklist.token_in_blacklist(jti)
 
 
+def encode_access_token(user: dict) -> str:
+    """Creates an access token for the user, like flask_jwt_extended.create_access_token does
+
+    the token is signed by the active key of key_ring and carries its id as the 'kid' header.
+    """
+    now = datetime.utcnow()
+    token_data = {
+        'iat': now,
+        'nbf': now,
+        'jti': str(uuid.uuid4()),
+        'exp': now + config.access_expires,
+        config.identity_claim_key: user_identity_lookup(user),
+        'fresh': False,
+        'type': 'access',
+        config.user_claims_key: add_claims_to_access_token(user)
+    }
+    headers = {'kid': key_ring.kid} if key_ring.kid else None
+    return pyjwt.encode(
+        token_data, key_ring.signing_key, key_ring.algorithm, headers=headers, json_encoder=config.json_encoder
+    ).decode('utf-8')
+
+
+def decode_verified_token(encoded_token: str) -> dict:
+    """Decodes the token and verifies its signature, expiry and user claims
+
+    the signature is verified by the key_ring key named in the token header.
+    verified tokens are cached per worker until they expire, callers should still check the blacklist.
+    :raises InvalidTokenError: if the token is expired, its key is unknown or its signature is invalid.
+    :raises JWTDecodeError: if the token lacks mandatory claims.
+    :raises UserClaimsVerificationError: if the user claims verification fails.
+    """
+    jwt_data = jwt_cache.get(encoded_token)
+    if jwt_data is not None:
+        return jwt_data
+    with jwt_decode_seconds.time():
+        jwt_data = decode_jwt(
+            encoded_token=encoded_token,
+            secret=key_ring.verifying_key(encoded_token),
+            algorithm=key_ring.algorithm,
+            identity_claim_key=config.identity_claim_key,
+            user_claims_key=config.user_claims_key
+        )
+        verify_token_claims(jwt_data)
+    jwt_cache.set(encoded_token, jwt_data, ttl=jwt_data["exp"] - time.time() if "exp" in jwt_data else None)
+    return jwt_data
+
+
+def token_from_header(jwt_header: str) -> str:
+    """Returns the encoded token of the authorization header value
+
+    :raises NoAuthorizationError: if there is no token in the header.
+    :raises InvalidHeaderError: if the header is malformed.
+    """
+    if not jwt_header:
+        raise NoAuthorizationError("Missing {} Header".format(config.header_name))
+    parts = jwt_header.split()
+    if not config.header_type:
+        if len(parts) != 1:
+            raise InvalidHeaderError("Bad {} header. Expected value '<JWT>'".format(config.header_name))
+        encoded_token = parts[0]
+    else:
+        if parts[0] != config.header_type or len(parts) != 2:
+            raise InvalidHeaderError(
+                "Bad {} header. Expected value '{} <JWT>'".format(config.header_name, config.header_type)
+            )
+        encoded_token = parts[1]
+    return encoded_token
+
+
+def verify_jwt_in_request():
+    """Replaces flask_jwt_extended.verify_jwt_in_request for tokens in the header
+
+    verifies the token by decode_verified_token so every key of key_ring is accepted,
+    get_raw_jwt and get_jwt_claims keep working afterwards.
+    :raises NoAuthorizationError: if there is no token in the header.
+    :raises InvalidHeaderError: if the header is malformed.
+    :raises RevokedTokenError: if the token is in blacklist.
+    """
+    if request.method in config.exempt_methods:
+        return
+    jwt_data = decode_verified_token(token_from_header(request.headers.get(config.header_name, None)))
+    verify_token_type(jwt_data, expected_type='access')
+    verify_token_not_blacklisted(jwt_data, request_type='access')
+    _app_ctx_stack.top.jwt = jwt_data
+
+
+def jwt_required(fn):
+    """Protects a view like flask_jwt_extended.jwt_required, using verify_jwt_in_request of this module"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        verify_jwt_in_request()
+        return fn(*args, **kwargs)
+    return wrapper
+
+
 def access_required(resources: list):
     def decorator(fn):
         @wraps(fn)
@@ -43,7 +145,9 @@ def access_required(resources: list):
             claims = get_jwt_claims()
             result = LocalUserManager.authorize(claims.get("roles", []), resources)
             if False in result.values():
-                getLogger().info("access denied token: '{}'  resources/permissions: '{}'".format(get_raw_jwt(), result))
+                getLogger().info("access denied token with jti '{}' resources/permissions: '{}'".format(
+                    get_raw_jwt()["jti"], result
+                ))
                 return "Access denied", 403
             return fn(*args, **kwargs)
         return wrapper
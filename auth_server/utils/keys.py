@@ -0,0 +1,121 @@
+import base64
+import hashlib
+import json
+import os
+import jwt as pyjwt
+from flask import Flask
+from jwt.exceptions import InvalidTokenError
+
+
+def _b64_uint(value: int, length: int=None) -> str:
+    length = length or (value.bit_length() + 7) // 8
+    return base64.urlsafe_b64encode(value.to_bytes(length, "big")).rstrip(b"=").decode("ascii")
+
+
+def public_jwk(public_key) -> dict:
+    """Returns the public key as a JSON web key, without kid, alg and use members"""
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec
+    if isinstance(public_key, rsa.RSAPublicKey):
+        numbers = public_key.public_numbers()
+        return {"kty": "RSA", "n": _b64_uint(numbers.n), "e": _b64_uint(numbers.e)}
+    if isinstance(public_key, ec.EllipticCurvePublicKey):
+        numbers = public_key.public_numbers()
+        length = (public_key.curve.key_size + 7) // 8
+        return {
+            "kty": "EC",
+            "crv": {"secp256r1": "P-256", "secp384r1": "P-384", "secp521r1": "P-521"}[public_key.curve.name],
+            "x": _b64_uint(numbers.x, length),
+            "y": _b64_uint(numbers.y, length)
+        }
+    raise TypeError("unsupported key type {}".format(type(public_key).__name__))
+
+
+def thumbprint(jwk: dict) -> str:
+    """RFC 7638 thumbprint of the JSON web key, used as the default key id"""
+    required = {"RSA": ("e", "kty", "n"), "EC": ("crv", "kty", "x", "y")}[jwk["kty"]]
+    canonical = json.dumps({k: jwk[k] for k in required}, separators=(",", ":"), sort_keys=True)
+    return base64.urlsafe_b64encode(hashlib.sha256(canonical.encode("utf-8")).digest()).rstrip(b"=").decode("ascii")
+
+
+class KeyRing:
+    """Keys used to sign and verify tokens
+
+    With an HS* algorithm tokens are signed and verified by JWT_SECRET_KEY and no key is published.
+    With an asymmetric algorithm (RS*, PS* or ES*) the private key in JWT_PRIVATE_KEY_FILE signs new tokens,
+    its public key and every '<kid>.pem' public key in JWT_PUBLIC_KEYS_DIR verify them and are published as JWKS,
+    so a retired key can stay in the directory until the tokens it signed expire.
+    """
+
+    def __init__(self, app: Flask=None):
+        self.algorithm = "HS256"
+        self.kid = None
+        self.signing_key = None
+        self.verifying_keys = {}
+        if app is not None:
+            self.init_app(app)
+
+    @property
+    def is_asymmetric(self) -> bool:
+        return not self.algorithm.startswith("HS")
+
+    def init_app(self, app: Flask):
+        self.algorithm = app.config["JWT_ALGORITHM"]
+        if not self.is_asymmetric:
+            self.kid = None
+            self.signing_key = app.config["JWT_SECRET_KEY"]
+            self.verifying_keys = {None: self.signing_key}
+            return
+
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+
+        private_key_file = app.config["JWT_PRIVATE_KEY_FILE"]
+        if not private_key_file:
+            raise TypeError("no JWT_PRIVATE_KEY_FILE env variable for algorithm {}".format(self.algorithm))
+        with open(private_key_file, "rb") as f:
+            private_pem = f.read()
+        self.signing_key = serialization.load_pem_private_key(private_pem, password=None, backend=default_backend())
+        public_key = self.signing_key.public_key()
+        self.kid = app.config["JWT_KEY_ID"] or thumbprint(public_jwk(public_key))
+        self.verifying_keys = {self.kid: public_key}
+
+        public_keys_dir = app.config["JWT_PUBLIC_KEYS_DIR"]
+        if public_keys_dir:
+            for file_name in sorted(os.listdir(public_keys_dir)):
+                if not file_name.endswith(".pem"):
+                    continue
+                with open(os.path.join(public_keys_dir, file_name), "rb") as f:
+                    self.verifying_keys.setdefault(
+                        file_name[:-len(".pem")],
+                        serialization.load_pem_public_key(f.read(), backend=default_backend())
+                    )
+
+        # flask_jwt_extended only needs them to be present for an asymmetric algorithm
+        app.config["JWT_PRIVATE_KEY"] = private_pem
+        app.config["JWT_PUBLIC_KEY"] = public_key.public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+
+    def verifying_key(self, encoded_token: str):
+        """Returns the key that verifies the token according to the kid in its header
+
+        :raises InvalidTokenError: if the token header is malformed or its key is unknown.
+        """
+        if not self.is_asymmetric:
+            return self.signing_key
+        kid = pyjwt.get_unverified_header(encoded_token).get("kid")
+        try:
+            return self.verifying_keys[kid]
+        except KeyError:
+            raise InvalidTokenError("unknown key id '{}'".format(kid))
+
+    def jwks(self) -> dict:
+        """Returns the public keys as a JSON web key set"""
+        if not self.is_asymmetric:
+            return {"keys": []}
+        keys = []
+        for kid, public_key in self.verifying_keys.items():
+            jwk = public_jwk(public_key)
+            jwk.update(kid=kid, use="sig", alg=self.algorithm)
+            keys.append(jwk)
+        return {"keys": keys}
@@ -0,0 +1,125 @@
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler
+from auth_server.utils import fast_json
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single line json object
+
+    the traceback of the record and the numbers of records suppressed by RateLimitFilter
+    or dropped by QueueLogHandler before it are included if there are any.
+    """
+
+    def __init__(self, prefix: str=""):
+        super().__init__()
+        self.prefix = prefix
+
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            "time": self.formatTime(record),
+            "service": self.prefix,
+            "level": record.levelname,
+            "module": record.module,
+            "line": record.lineno,
+            "pid": record.process,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        for key in ("suppressed", "dropped"):
+            if getattr(record, key, 0):
+                document[key] = getattr(record, key)
+        return fast_json.dumps(document)
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most rate records of a call site per interval seconds, the rest are counted and dropped
+
+    a burst of the same failure, e.g. invalid tokens, is logged by its first records and the number
+    suppressed, set as the 'suppressed' attribute of the next record passed from the same call site.
+    """
+
+    def __init__(self, rate: int, interval: float=1):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        # call site -> [window start, records passed in the window, records suppressed since the last one passed]
+        self.__windows = {}
+        self.__lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.__lock:
+            window = self.__windows.setdefault((record.pathname, record.lineno), [now, 0, 0])
+            if now - window[0] >= self.interval:
+                window[0] = now
+                window[1] = 0
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+            record.suppressed, window[2] = window[2], 0
+        return True
+
+
+class QueueLogHandler(QueueHandler):
+    """Hands the records to a writer thread, so logging never blocks the caller on the output
+
+    the thread is started by the first record of each process, so workers forked after set_logging
+    write their own records. once maxsize records are waiting the new ones are dropped and counted,
+    the count is set as the 'dropped' attribute of the next record queued.
+    """
+
+    def __init__(self, target: logging.Handler, maxsize: int=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.dropped = 0
+        self.__pid = None
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the arguments are merged now as they may change later, the traceback is formatted by the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.__pid != os.getpid():
+            self.__start()
+        record.dropped, self.dropped = self.dropped, 0
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += record.dropped + 1
+
+    def __start(self):
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+            # records queued by the parent before the fork are written by the parent
+            self.queue = queue.Queue(self.queue.maxsize)
+            self.__thread = threading.Thread(target=self.__write, name="log writer", daemon=True)
+            self.__thread.start()
+            self.__pid = os.getpid()
+
+    def __write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            self.target.handle(record)
+
+    def close(self):
+        """Writes the queued records and stops the writer thread of the process, called by logging at exit"""
+        if self.__pid == os.getpid() and self.__thread.is_alive():
+            self.queue.put(None)
+            self.__thread.join()
+        self.target.close()
+        super().close()
@@ -0,0 +1,127 @@
+import os
+import time
+from flask import Flask, Response, request, g, has_request_context
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# workers write their samples to files in this directory, summed up by the worker serving /metrics
+MULTIPROCESS_DIR = "prometheus_multiproc_dir"
+
+REQUEST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+DEPENDENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+
+request_seconds = Histogram(
+    "auth_http_request_duration_seconds", "Latency of the requests by endpoint, method and status",
+    ["endpoint", "method", "status"], buckets=REQUEST_BUCKETS
+)
+
+db_query_seconds = Histogram(
+    "auth_db_query_duration_seconds", "Latency of the database queries by their first keyword",
+    ["operation"], buckets=DEPENDENCY_BUCKETS
+)
+
+db_queries_per_request = Histogram(
+    "auth_db_queries_per_request", "Number of database queries of the requests by endpoint",
+    ["endpoint"], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+
+redis_command_seconds = Histogram(
+    "auth_redis_command_duration_seconds", "Latency of the redis commands of the blacklist",
+    ["command"], buckets=DEPENDENCY_BUCKETS
+)
+
+jwt_decode_seconds = Histogram(
+    "auth_jwt_decode_duration_seconds", "Latency of decoding and verifying tokens missing from the jwt cache",
+    buckets=DEPENDENCY_BUCKETS
+)
+
+serialization_seconds = Histogram(
+    "auth_serialization_duration_seconds", "Latency of the responses serialized by the serializers registry",
+    ["schema"], buckets=DEPENDENCY_BUCKETS
+)
+
+startup_seconds = Histogram(
+    "auth_startup_duration_seconds", "Time from the import of the package to the app being created, by app profile",
+    ["profile"], buckets=(.1, .25, .5, 1, 2, 5, 10, 30)
+)
+
+cache_lookups = Counter(
+    "auth_cache_lookups_total", "Lookups of the per worker caches by their result, hit or miss", ["cache", "result"]
+)
+
+OPERATIONS = {"select", "insert", "update", "delete"}
+
+
+def operation(statement: str) -> str:
+    """Returns the first keyword of the sql statement if it is one of OPERATIONS, otherwise 'other'"""
+    keyword = statement.lstrip()[:6].lower()
+    return keyword if keyword in OPERATIONS else "other"
+
+
+def endpoint() -> str:
+    """Returns the url rule of the request, which keeps the label count bounded unlike the path"""
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def start_request_timer():
+    g.metrics_started_at = time.perf_counter()
+    g.metrics_db_queries = 0
+
+
+def observe_request(response: Response) -> Response:
+    started_at = g.get("metrics_started_at")
+    if started_at is not None:
+        name = endpoint()
+        request_seconds.labels(name, request.method, response.status_code).observe(time.perf_counter() - started_at)
+        db_queries_per_request.labels(name).observe(g.metrics_db_queries)
+    return response
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started_at", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    db_query_seconds.labels(operation(statement)).observe(time.perf_counter() - conn.info["metrics_started_at"].pop())
+    if has_request_context() and "metrics_db_queries" in g:
+        g.metrics_db_queries += 1
+
+
+def metrics():
+    """Serves the metrics in the prometheus text format, of all workers if they share MULTIPROCESS_DIR"""
+    if MULTIPROCESS_DIR in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def init_app(app: Flask, engine: Engine):
+    """Times the requests of the app and the queries of the engine and serves the metrics on '/metrics'
+
+    should be called before other after_request functions are registered, so the time they take is included.
+    """
+    app.before_request(start_request_timer)
+    app.after_request(observe_request)
+    instrument(engine)
+    app.add_url_rule("/metrics", "metrics", metrics, methods=["GET"])
+
+
+def instrument(engine: Engine):
+    """Times the queries of the engine, once however many times it is called"""
+    if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def clear_multiprocess_dir():
+    """Removes the samples of the previous run of the server, to be called before the workers start"""
+    directory = os.environ.get(MULTIPROCESS_DIR)
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith(".db"):
+                os.remove(os.path.join(directory, name))
@@ -1,5 +1,303 @@
+import base64
+import fcntl
 import hashlib
+import hmac
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from flask import Flask
+
+
+class HashingBusy(Exception):
+    """Raised when no hashing worker got free within the queue timeout"""
+    pass
+
+
+class HashingSlots:
+    """Bounds the hashes running at once on the node, across the workers and their threads
+
+    a slot is an exclusive flock on one of size files in directory, which the workers of the node share.
+    the lock is released by the kernel if its holder dies. each process opens the files once, and guards each
+    one by a thread lock as the threads of a process share its flock.
+    """
+
+    def __init__(self, directory: str, size: int):
+        os.makedirs(directory, exist_ok=True)
+        self.__paths = [os.path.join(directory, "slot-{}.lock".format(i)) for i in range(size)]
+        self.__fds = []
+        self.__locks = []
+        self.__turn = itertools.count()
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def __open(self):
+        """Opens the files once per process, a forked worker would share the flocks of its parent"""
+        if self.__pid != os.getpid():
+            with self.__lock:
+                if self.__pid != os.getpid():
+                    for fd in self.__fds:
+                        os.close(fd)
+                    self.__fds = [os.open(path, os.O_RDWR | os.O_CREAT, 0o600) for path in self.__paths]
+                    self.__locks = [threading.Lock() for _ in self.__paths]
+                    self.__pid = os.getpid()
+
+    def __try(self, slot: int) -> bool:
+        if not self.__locks[slot].acquire(blocking=False):
+            return False
+        try:
+            fcntl.flock(self.__fds[slot], fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.__locks[slot].release()
+            return False
+        return True
+
+    def acquire(self, timeout: float, blocking: bool=True):
+        """Returns a free slot, None if none got free within timeout
+
+        if all are taken, it waits for the next one in turn, by a blocking flock in a daemon thread. a wait
+        given up leaves its thread to release the slot as soon as it gets it.
+        """
+        self.__open()
+        for slot in range(len(self.__paths)):
+            if self.__try(slot):
+                return slot
+        if not blocking:
+            return None
+        deadline = time.monotonic() + timeout
+        slot = next(self.__turn) % len(self.__paths)
+        if not self.__locks[slot].acquire(timeout=max(timeout, 0)):
+            return None
+        locked = threading.Event()
+        # whichever of the thread and the caller is the later one releases the slot if the wait is given up
+        handoff = threading.Lock()
+        given_up = []
+
+        def wait():
+            try:
+                fcntl.flock(self.__fds[slot], fcntl.LOCK_EX)
+            except OSError as e:
+                getLogger().error("hashing slot cannot be locked: {}".format(e))
+                given_up.append(e)
+            with handoff:
+                if given_up:
+                    self.release(slot)
+                else:
+                    locked.set()
+
+        threading.Thread(target=wait, name="hashing slot waiter", daemon=True).start()
+        locked.wait(max(deadline - time.monotonic(), 0))
+        with handoff:
+            if locked.is_set():
+                return slot
+            given_up.append(None)
+        return None
+
+    def release(self, slot: int):
+        fcntl.flock(self.__fds[slot], fcntl.LOCK_UN)
+        self.__locks[slot].release()
+
+
+class Sha512Hasher:
+    """Unsalted sha512 hex digests, the format of the passwords stored before salted hashers, verified only"""
+    algorithm = "sha512"
+
+    def encode(self, password: str) -> str:
+        return hashlib.sha512(password.encode("utf-8")).hexdigest()
+
+    def verify(self, password: str, encoded: str) -> bool:
+        return hmac.compare_digest(self.encode(password), encoded)
+
+    def needs_update(self, encoded: str) -> bool:
+        return True
+
+
+class Pbkdf2Hasher:
+    """PBKDF2-HMAC-SHA256 hashes stored as 'pbkdf2_sha256$iterations$salt$hash'"""
+    algorithm = "pbkdf2_sha256"
+
+    def __init__(self, iterations: int):
+        self.iterations = iterations
+
+    def encode(self, password: str, salt: str=None, iterations: int=None) -> str:
+        salt = salt or base64.b64encode(os.urandom(16)).decode("ascii")
+        iterations = iterations or self.iterations
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("ascii"), iterations)
+        return "{}${}${}${}".format(
+            self.algorithm, iterations, salt, base64.b64encode(digest).decode("ascii")
+        )
+
+    def verify(self, password: str, encoded: str) -> bool:
+        algorithm, iterations, salt, _ = encoded.split("$", 3)
+        return hmac.compare_digest(self.encode(password, salt, int(iterations)), encoded)
+
+    def needs_update(self, encoded: str) -> bool:
+        return int(encoded.split("$", 2)[1]) != self.iterations
+
+
+class ScryptHasher:
+    """scrypt hashes stored as 'scrypt$n$r$p$salt$hash', available if python is built against OpenSSL 1.1+"""
+    algorithm = "scrypt"
+
+    def __init__(self, n: int, r: int, p: int):
+        if not hasattr(hashlib, "scrypt"):
+            raise ValueError("scrypt is not supported by the OpenSSL python is built against")
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def encode(self, password: str, salt: str=None, n: int=None, r: int=None, p: int=None) -> str:
+        salt = salt or base64.b64encode(os.urandom(16)).decode("ascii")
+        n, r, p = n or self.n, r or self.r, p or self.p
+        digest = hashlib.scrypt(
+            password.encode("utf-8"), salt=salt.encode("ascii"), n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024
+        )
+        return "{}${}${}${}${}${}".format(self.algorithm, n, r, p, salt, base64.b64encode(digest).decode("ascii"))
+
+    def verify(self, password: str, encoded: str) -> bool:
+        algorithm, n, r, p, salt, _ = encoded.split("$", 5)
+        return hmac.compare_digest(self.encode(password, salt, int(n), int(r), int(p)), encoded)
+
+    def needs_update(self, encoded: str) -> bool:
+        return encoded.split("$", 4)[1:4] != [str(self.n), str(self.r), str(self.p)]
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords by the configured hasher, at most 'concurrency' at once on the node.
+
+    The slots are shared by all workers of the node, so a burst of logins keeps at most 'concurrency' of them
+    hashing, callers waiting longer than queue_timeout for a free slot fail with HashingBusy and free their worker.
+    Passwords stored by any known hasher are verified, the ones stored by another hasher or parameters
+    are reported by verify so they can be rehashed.
+    """
+
+    def __init__(self):
+        self.__hasher = None
+        self.__legacy = Sha512Hasher()
+        # algorithm -> hasher verifying its stored hashes, by the parameters stored along each hash
+        self.__verifiers = {}
+        # hash of a random password by the configured hasher, verified against when the user does not exist
+        self.__dummy = None
+        self.__queue_timeout = None
+        self.__slots = None
+        # threads of hash_many, one per slot it holds
+        self.__executor = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def init_app(self, app: Flask):
+        algorithm = app.config["PASSWORD_HASHER"]
+        self.__verifiers = {Pbkdf2Hasher.algorithm: Pbkdf2Hasher(app.config["PASSWORD_PBKDF2_ITERATIONS"])}
+        if hasattr(hashlib, "scrypt"):
+            self.__verifiers[ScryptHasher.algorithm] = ScryptHasher(
+                app.config["PASSWORD_SCRYPT_N"], app.config["PASSWORD_SCRYPT_R"], app.config["PASSWORD_SCRYPT_P"]
+            )
+        if algorithm not in (Pbkdf2Hasher.algorithm, ScryptHasher.algorithm):
+            raise ValueError("PASSWORD_HASHER should be one of pbkdf2_sha256 or scrypt")
+        if algorithm not in self.__verifiers:
+            raise ValueError("scrypt is not supported by the OpenSSL python is built against")
+        self.__hasher = self.__verifiers[algorithm]
+        self.__dummy = None
+        self.__slots = HashingSlots(app.config["PASSWORD_HASH_SLOTS_DIR"], app.config["PASSWORD_HASH_CONCURRENCY"])
+        self.__queue_timeout = app.config["PASSWORD_HASH_QUEUE_TIMEOUT"]
+        self.__concurrency = app.config["PASSWORD_HASH_CONCURRENCY"]
+        self.__pid = None
+
+    def __hasher_of(self, encoded: str):
+        """Returns the hasher verifying the stored hash, None if python cannot compute it"""
+        algorithm = encoded.split("$", 1)[0]
+        if algorithm in (Pbkdf2Hasher.algorithm, ScryptHasher.algorithm):
+            return self.__verifiers.get(algorithm)
+        return self.__legacy
+
+    def __start_pool(self):
+        """Creates the threads of hash_many once per process, threads do not survive forking workers"""
+        if self.__pid != os.getpid():
+            with self.__lock:
+                if self.__pid != os.getpid():
+                    self.__executor = ThreadPoolExecutor(max_workers=self.__concurrency)
+                    self.__pid = os.getpid()
+
+    def __run(self, fn, *args):
+        """Runs fn in the calling thread while holding a slot"""
+        slot = self.__slots.acquire(self.__queue_timeout)
+        if slot is None:
+            raise HashingBusy
+        try:
+            return fn(*args)
+        finally:
+            self.__slots.release(slot)
+
+    def hash(self, password: str) -> str:
+        """Returns the salted hash of the password to be stored
+
+        :raises HashingBusy: if no slot got free within the queue timeout.
+        """
+        return self.__run(self.__hasher.encode, password)
+
+    def hash_many(self, passwords: list) -> list:
+        """Batch variant of hash, spreads the passwords over threads, one per slot that is free
+
+        :raises HashingBusy: if no slot got free within the queue timeout.
+        """
+        self.__start_pool()
+        slot = self.__slots.acquire(self.__queue_timeout)
+        if slot is None:
+            raise HashingBusy
+        taken = [slot]
+        while len(taken) < len(passwords):
+            slot = self.__slots.acquire(0, blocking=False)
+            if slot is None:
+                break
+            taken.append(slot)
+        try:
+            chunks = self.__executor.map(
+                lambda chunk: [self.__hasher.encode(p) for p in chunk],
+                [passwords[i::len(taken)] for i in range(len(taken))]
+            )
+            result = [None] * len(passwords)
+            for i, chunk in enumerate(chunks):
+                result[i::len(taken)] = chunk
+            return result
+        finally:
+            for slot in taken:
+                self.__slots.release(slot)
+
+    def verify(self, password: str, encoded: str) -> tuple:
+        """Checks the password against the stored hash
+
+        :return: a (matches, new hash) tuple, new hash is None unless the password matches and
+        the stored hash should be replaced by it.
+        :raises HashingBusy: if no slot got free within the queue timeout.
+        """
+        hasher = self.__hasher_of(encoded)
+        if hasher is None:
+            getLogger().error("password hash cannot be verified, scrypt is not supported by the OpenSSL python is "
+                              "built against")
+            return False, None
+        if not self.__run(hasher.verify, password, encoded):
+            return False, None
+        if hasher is self.__hasher and not hasher.needs_update(encoded):
+            return True, None
+        return True, self.__run(self.__hasher.encode, password)
+
+    def verify_missing(self, password: str):
+        """Takes as long as verify of a stored hash, for logins of unknown users to not tell them apart
+
+        :raises HashingBusy: if no slot got free within the queue timeout.
+        """
+        self.__run(self.__verify_dummy, password)
+
+    def __verify_dummy(self, password: str) -> bool:
+        if self.__dummy is None:
+            self.__dummy = self.__hasher.encode(base64.b64encode(os.urandom(16)).decode("ascii"))
+        return self.__hasher.verify(password, self.__dummy)
+
+
+password_hasher = PasswordHasher()
 
 
 def hash_password(password: str) -> str:
-    return hashlib.sha512(password.encode("utf-8")).hexdigest()
+    return password_hasher.hash(password)
@@ -0,0 +1,59 @@
+from logging import getLogger
+import redis
+from auth_server import authorization_cache, policy_version, identity_version
+from auth_server.models.policy_index import policy_index
+from auth_server.models.replicas import replicas
+
+
+def policy_changed():
+    """Drops everything derived from the roles, resources and resource_roles graph in this worker
+    and bumps the policy version.
+
+    Must be called after any write to one of those tables, other workers catch up when they see the new version.
+    the write is already committed, so a failure of redis is logged rather than raised, this worker still reloads.
+    """
+    authorization_cache.clear()
+    policy_index.invalidate()
+    try:
+        policy_version.bump()
+    except redis.RedisError as e:
+        getLogger().error("policy version cannot be bumped, it is retried by the next read of the version: {}".format(
+            e
+        ))
+
+
+def identity_changed(affects_policy: bool=False):
+    """Bumps the identity version, must be called after any write to users, roles, resources or their relations
+
+    :param affects_policy: whether policy_changed should be called too.
+    """
+    if affects_policy:
+        policy_changed()
+    try:
+        identity_version.bump()
+    except redis.RedisError as e:
+        getLogger().error("identity version cannot be bumped, it is retried by the next read of the version: {}".format(
+            e
+        ))
+
+
+def identity_tag() -> str:
+    """Returns the entity tag of the responses read from the identity tables"""
+    version = identity_version.current()
+    replicas.saw_version("identity", version)
+    return "identity-{}".format(version)
+
+
+def resources_tag(roles: list) -> str:
+    """Returns the entity tag of the resources allowed by the roles, by the policy version they are answered at
+
+    None if the version is not known.
+    """
+    if policy_index.enabled:
+        version = policy_index.version()
+    else:
+        version = policy_version.current()
+        replicas.saw_version("policy", version)
+    if version is None:
+        return None
+    return "policy-{}-{}".format(version, ".".join(sorted(str(role) for role in roles)))
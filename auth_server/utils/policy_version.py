@@ -0,0 +1,32 @@
+import redis
+from flask import Flask
+
+
+class PolicyVersion:
+    """Version number of a part of the database, shared by all workers through redis and bumped by its writes
+
+    by default of the roles, resources and resource_roles graph. a bump failing on redis is retried
+    by the next current or bump of the worker, so the change is told to the others once redis is back.
+    :param config_key: the app.config key of the redis key holding the version.
+    """
+
+    def __init__(self, config_key: str="REDIS_POLICY_VERSION"):
+        self.__config_key = config_key
+        self.__redis = None
+        self.__key = None
+        self.__unpublished = False
+
+    def init_app(self, app: Flask, redis_client: redis.StrictRedis):
+        self.__redis = redis_client
+        self.__key = app.config[self.__config_key]
+
+    def current(self) -> int:
+        if self.__unpublished:
+            return self.bump()
+        return int(self.__redis.get(self.__key) or 0)
+
+    def bump(self) -> int:
+        self.__unpublished = True
+        version = self.__redis.incr(self.__key)
+        self.__unpublished = False
+        return version
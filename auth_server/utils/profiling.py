@@ -0,0 +1,139 @@
+import cProfile
+import os
+import random
+import re
+import time
+import tracemalloc
+from logging import getLogger
+from flask import Flask, request, g, current_app
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import InvalidTokenError
+from auth_server.config import url_prefix
+
+# resource a token should have access to for profiling requests and tracing memory of the workers
+DEBUG_RESOURCE = url_prefix[1:] + ':debug:r'
+
+# allocations of tracemalloc itself and of the import machinery are left out of the snapshots
+TRACEMALLOC_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def may_debug(encoded_token: str) -> bool:
+    """Whether the token is valid, not revoked and has access to DEBUG_RESOURCE"""
+    from auth_server import blacklist
+    from auth_server.user_manager.local_user_manager import LocalUserManager
+    from auth_server.utils.jwt import decode_verified_token
+    try:
+        jwt_data = decode_verified_token(encoded_token)
+        roles = jwt_data["user_claims"]["roles"]
+    except (InvalidTokenError, JWTExtendedException, KeyError):
+        return False
+    if blacklist.token_in_blacklist(jwt_data["jti"]):
+        return False
+    return LocalUserManager.authorize(roles, [DEBUG_RESOURCE])[DEBUG_RESOURCE] is not False
+
+
+def should_profile() -> bool:
+    """Whether the request is sampled by PROFILE_SAMPLE_PERCENT or carries a token of DEBUG_RESOURCE in PROFILE_HEADER"""
+    encoded_token = request.headers.get(current_app.config["PROFILE_HEADER"])
+    if encoded_token is not None:
+        if may_debug(encoded_token):
+            return True
+        getLogger().warning("profiling header ignored, the token has no access to {}".format(DEBUG_RESOURCE))
+    return random.random() * 100 < current_app.config["PROFILE_SAMPLE_PERCENT"]
+
+
+def start_profile():
+    if should_profile():
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+
+def dump_profile(exc=None):
+    """Stops the profiler of the request and writes its stats to PROFILE_DIR
+
+    the file is named by the time, the worker, the method and the endpoint of the request, e.g.
+    '1539262800123-42-POST-auth.authorize.prof', and is readable by pstats or snakeviz.
+    """
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+    profile.disable()
+    name = "{}-{}-{}-{}.prof".format(
+        int(time.time() * 1000), os.getpid(), request.method, re.sub(r"[^\w.-]", "_", request.endpoint or "unmatched")
+    )
+    path = os.path.join(current_app.config["PROFILE_DIR"], name)
+    try:
+        profile.dump_stats(path)
+    except OSError as e:
+        getLogger().error("profile of the request cannot be written to {}: {}".format(path, e))
+
+
+def init_app(app: Flask):
+    """Profiles the sampled requests of the app if PROFILING is enabled
+
+    should be called before other before_request functions are registered, so the time they take is included.
+    """
+    if not app.config["PROFILING"]:
+        return
+    os.makedirs(app.config["PROFILE_DIR"], exist_ok=True)
+    app.before_request(start_profile)
+    app.teardown_request(dump_profile)
+
+
+class MemoryTracer:
+    """Snapshots of tracemalloc of the worker, each one is compared to the previous one"""
+
+    def __init__(self):
+        self.__snapshot = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int=1):
+        """Starts tracing allocations with the given depth of tracebacks and takes the first snapshot"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.__snapshot = self.take_snapshot()
+
+    def stop(self):
+        tracemalloc.stop()
+        self.__snapshot = None
+
+    @staticmethod
+    def take_snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_FILTERS)
+
+    def diff(self, key_type: str="lineno", limit: int=20) -> list:
+        """Returns the allocations grown the most since the previous snapshot, which is replaced by a new one
+
+        :param key_type: groups the allocations by 'lineno', 'filename' or 'traceback'.
+        :param limit: number of statistics returned.
+        :return: dicts of the traceback, size, size_diff, count and count_diff of the allocations.
+        :raises RuntimeError: if tracemalloc is not tracing.
+        """
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not tracing")
+        snapshot = self.take_snapshot()
+        if self.__snapshot is None:
+            stats = snapshot.statistics(key_type)
+        else:
+            stats = snapshot.compare_to(self.__snapshot, key_type)
+        self.__snapshot = snapshot
+        return [
+            {
+                "traceback": [str(frame) for frame in stat.traceback],
+                "size": stat.size,
+                "size_diff": getattr(stat, "size_diff", stat.size),
+                "count": stat.count,
+                "count_diff": getattr(stat, "count_diff", stat.count)
+            }
+            for stat in stats[:limit]
+        ]
+
+
+memory_tracer = MemoryTracer()
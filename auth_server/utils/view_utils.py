@@ -1,5 +1,8 @@
 from functools import wraps
-from flask import request
+from logging import getLogger
+import redis
+from flask import request, make_response
+from auth_server.utils import fast_json
 
 
 def json_or_400(fn):
@@ -10,3 +13,41 @@ def json_or_400(fn):
         else:
             return fn(*args, **kwargs)
     return wrapper
+
+
+def etag_by(tag_of):
+    """Tags the responses of the view by the weak entity tag tag_of returns, computed before the view runs
+
+    a request whose If-None-Match carries the tag is answered 304 without running the view.
+    no tag is set if tag_of returns None or redis, which usually holds what tags are derived from, is not available.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                tag = tag_of()
+            except redis.RedisError as e:
+                getLogger().warning("responses are not tagged, redis is not available: {}".format(e))
+                tag = None
+            if tag is None:
+                return fn(*args, **kwargs)
+            if request.if_none_match.contains_weak(tag):
+                response = make_response("", 304)
+            else:
+                response = make_response(fn(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(tag, weak=True)
+            return response
+        return wrapper
+    return decorator
+
+
+def request_json():
+    """request.get_json by fast_json, the bodies it cannot decode are left to get_json and its errors"""
+    if request.is_json:
+        try:
+            return fast_json.loads(request.get_data(cache=True))
+        except ValueError:
+            pass
+    return request.get_json()
@@ -0,0 +1,43 @@
+SEPARATOR = ":"
+WILDCARD = "*"
+
+
+def is_wildcard(path: str) -> bool:
+    """Whether the resource path grants every path under its prefix, like 'billing:*' or '*'"""
+    return path == WILDCARD or path.endswith(SEPARATOR + WILDCARD)
+
+
+def covering_paths(path: str) -> list:
+    """Returns the wildcard resource paths granting the path, the most specific first
+
+    e.g. 'billing:invoices:r' is granted by 'billing:invoices:*', 'billing:*' and '*'.
+    """
+    segments = path.split(SEPARATOR)
+    return [SEPARATOR.join(segments[:i] + [WILDCARD]) for i in range(len(segments) - 1, -1, -1)]
+
+
+def match_grants(paths: set, granted: dict) -> list:
+    """Resolves the requested paths against the granted resources
+
+    :param paths: requested resource paths.
+    :param granted: dict of granted resource path/value, wildcard paths included.
+    :return: (path, value) tuples of the allowed paths, valued by the exact grant or the most specific wildcard one.
+    """
+    result = []
+    for path in paths:
+        if path in granted:
+            result.append((path, granted[path]))
+            continue
+        for wildcard in covering_paths(path):
+            if wildcard in granted:
+                result.append((path, granted[wildcard]))
+                break
+    return result
+
+
+def expand_paths(paths: set) -> set:
+    """Returns the paths along with all wildcard paths granting them, to be looked up in the database"""
+    expanded = set(paths)
+    for path in paths:
+        expanded.update(covering_paths(path))
+    return expanded
@@ -1,53 +1,113 @@
 from logging import getLogger
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import create_access_token, jwt_required, get_raw_jwt, get_jwt_claims
-from flask_jwt_extended.config import config
+from flask import Blueprint, request, jsonify, current_app
+from flask_jwt_extended import get_raw_jwt, get_jwt_claims
 from flask_jwt_extended.exceptions import JWTDecodeError, UserClaimsVerificationError
-from flask_jwt_extended.tokens import decode_jwt
-from flask_jwt_extended.utils import verify_token_claims
+from jwt import InvalidTokenError, ExpiredSignatureError
 from marshmallow import ValidationError
-from auth_server.models.auth_model import get_user_resources_by_roles
-from auth_server.serializers.auth_serializers import TokenInput, TokenOutput, AuthorizeInput, AuthorizeOutput
+from auth_server import blacklist, key_ring, policy_version
+from auth_server.serializers.auth_serializers import TokenInput, TokenOutput, AuthorizeInput, AuthorizeOutput, \
+    BatchAuthorizeOutput, PolicyVersionOutput
 from auth_server.serializers.identity_serializers import ResourceSerializer
+from auth_server.serializers.registry import schema, dumps
 from auth_server.user_manager.local_user_manager import LocalUserManager
-from auth_server.utils.blacklist import UserBlackList
-from auth_server.utils.view_utils import json_or_400
+from auth_server.utils.jwt import decode_verified_token, encode_access_token, jwt_required
+from auth_server.utils.password import HashingBusy
+from auth_server.utils.policy import resources_tag
+from auth_server.utils.view_utils import json_or_400, etag_by, request_json
 
 
 auth_bp = Blueprint('auth', __name__)
 
 user_manger_class = LocalUserManager
-user_blacklist_class = UserBlackList
+user_blacklist = blacklist
+
+
+class TokenRejected(Exception):
+    """Raised by token_roles with the message and the http status of the rejection"""
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def token_roles(encoded_token: str) -> tuple:
+    """Decodes the token of an authorize request, blacklist is not checked
+
+    :return: the jti and roles of the token.
+    :raises TokenRejected: if the token is invalid.
+    """
+    try:
+        jwt_data = decode_verified_token(encoded_token)
+        return jwt_data["jti"], jwt_data["user_claims"]["roles"]
+    except ExpiredSignatureError:
+        raise TokenRejected("token has expired", 401)
+    except (InvalidTokenError, JWTDecodeError):
+        raise TokenRejected("jwt cannot be decoded", 422)
+    except UserClaimsVerificationError:
+        raise TokenRejected("jwt claims verification failed", 422)
+    except KeyError:
+        raise TokenRejected("bad format claims", 422)
+
+
+def embeds_resources(username: str, service_name: str) -> bool:
+    """Whether the tokens of the user should embed the resources of the user"""
+    return (
+        username in current_app.config["EMBED_RESOURCES_USERS"] or
+        service_name in current_app.config["EMBED_RESOURCES_SERVICES"]
+    )
 
 
 @auth_bp.route('/token', methods=['post'])
 @json_or_400
 def token():
-    input_schema = TokenInput()
-    output_schema = TokenOutput()
+    input_schema = schema(TokenInput)
     try:
-        user = input_schema.load(request.get_json())
+        user = input_schema.load(request_json())
     except ValidationError as e:
-        getLogger().info("Validation error for user login: {}, detail: {}".format(request.get_json(), e.messages))
+        getLogger().info("validation error for user login: {}".format(e.messages))
         return "Validation error, the input data is invalid", 400
     else:
         user_manager = user_manger_class(user["username"], password=user["password"])
-        user_from_db = user_manager.authenticate()
+        try:
+            user_from_db = user_manager.authenticate()
+        except HashingBusy:
+            getLogger().warning("no password hashing worker got free for user {}".format(user["username"]))
+            return "too many logins in progress, try again later", 503, {"Retry-After": "1"}
         if user_from_db is None:
             getLogger().info(
                 "user {} failed to authenticate".format(user["username"])
             )
             return "authentication failed, no such username or password", 401
-        # user_from_db is a python dictionary object that has 'username' and 'access' keys
-        access_token = create_access_token(identity=user_from_db)
-        return output_schema.dumps({"token": access_token}), 200
+        if embeds_resources(user["username"], user_from_db.get("service_name")):
+            # read the version first, so a concurrent change leaves the token stale rather than mislabeled
+            user_from_db["policy_version"] = policy_version.current()
+            user_from_db["resources"] = user_manger_class.resources_of(user_from_db["roles"])
+        # user_from_db is a python dictionary object that has 'id', 'service_name' and 'roles' keys
+        access_token = encode_access_token(user_from_db)
+        return dumps(TokenOutput, {"token": access_token}), 200
+
+
+@auth_bp.route('/.well-known/jwks.json', methods=['GET'])
+def jwks():
+    """Publishes the public keys verifying the tokens, empty for symmetric algorithms"""
+    response = jsonify(key_ring.jwks())
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["JWKS_MAX_AGE"]
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@auth_bp.route('/policy_version', methods=['GET'])
+def get_policy_version():
+    """Returns the current policy version, tokens embedding an older version carry stale resources"""
+    return dumps(PolicyVersionOutput, {"policy_version": policy_version.current()}), 200
 
 
 @auth_bp.route('/revoke', methods=['POST'])
 @jwt_required
 def revoke():
-    blacklist = user_blacklist_class()
-    blacklist.persist_token_in_blacklist(get_raw_jwt()['jti'])
+    user_blacklist.persist_token_in_blacklist(get_raw_jwt()['jti'])
     return "", 204
 
 
@@ -55,66 +115,106 @@ def revoke():
 @json_or_400
 def authorize():
     """Authorizes token if its valid and not expired and has access to provided resources"""
-    input_schema = AuthorizeInput()
-    output_schema = AuthorizeOutput()
+    input_schema = schema(AuthorizeInput)
     try:
-        in_data = input_schema.load(request.get_json())
+        in_data = input_schema.load(request_json())
     except ValidationError as e:
-        getLogger().exception(e)
         getLogger().error("validation error for authorize request: {}".format(e))
         return "bad format input for fields: {}".format(e.field_names), 422
 
     try:
-        jwt_data = decode_jwt(
-            encoded_token=in_data["token"],
-            secret=config.decode_key,
-            algorithm=config.algorithm,
-            identity_claim_key=config.identity_claim_key,
-            user_claims_key=config.user_claims_key
-        )
+        jwt_data = decode_verified_token(in_data["token"])
     except JWTDecodeError as e:
-        getLogger().exception(e)
-        getLogger().error("jwt cannot be decoded: {}".format(in_data["token"]))
+        getLogger().info("authorize: token rejected, jwt cannot be decoded: {}".format(e))
         return "jwt cannot be decoded", 422
+    except UserClaimsVerificationError as e:
+        getLogger().info("authorize: token rejected, jwt claims verification failed: {}".format(e))
+        return "jwt claims verification failed", 422
     else:
-        try:
-            verify_token_claims(jwt_data)
-        except UserClaimsVerificationError as e:
-            getLogger().exception(e)
-            getLogger().error("jwt claims verification failed: {}".format(in_data["token"]))
-            return "jwt claims verification failed", 422
-
         # check if token in revoked blacklist
-        blacklist = user_blacklist_class()
-        if blacklist.token_in_blacklist(jwt_data["jti"]):
-            getLogger().info(" authorize: token in revoke black list: {}".format(in_data))
+        if user_blacklist.token_in_blacklist(jwt_data["jti"]):
+            getLogger().info("authorize: token in black list, jti: {}".format(jwt_data["jti"]))
             return "token in black list", 401
 
         try:
             roles = jwt_data["user_claims"]["roles"]
         except KeyError as e:
-            getLogger().exception(e)
-            getLogger().error("cannot access jwt claims: {}".format(in_data))
+            getLogger().info("authorize: token rejected, no {} in its claims, jti: {}".format(e, jwt_data["jti"]))
             return "bad format claims", 422
         else:
             resources = user_manger_class.authorize(roles=roles, resources=in_data["resources"])
-            return output_schema.dumps({"token": in_data["token"], "resources": resources}), 200
+            return dumps(AuthorizeOutput, {"token": in_data["token"], "resources": resources}), 200
+
+
+@auth_bp.route('/authorize/batch', methods=['POST'])
+@json_or_400
+def authorize_batch():
+    """Batch variant of authorize, accepts a list of authorize requests and returns their results in the same order
+
+    an item whose token is rejected carries an error message and the http status the single authorize would return,
+    instead of failing the whole batch.
+    """
+    input_schema = schema(AuthorizeInput, many=True)
+    try:
+        in_data = input_schema.load(request_json())
+    except ValidationError as e:
+        getLogger().error("validation error for batch authorize request: {}".format(e.messages))
+        return "bad format input for items: {}".format(e.messages), 422
+    if len(in_data) > current_app.config["AUTHORIZE_BATCH_SIZE"]:
+        return "at most {} items are allowed in a batch".format(current_app.config["AUTHORIZE_BATCH_SIZE"]), 422
+
+    results = [{"token": item["token"]} for item in in_data]
+    # indexes of the items whose tokens are valid
+    valid = []
+    jwt_data_list = []
+    for i, item in enumerate(in_data):
+        try:
+            jwt_data_list.append(token_roles(item["token"]))
+        except TokenRejected as e:
+            results[i].update(error=e.message, status=e.status)
+        else:
+            valid.append(i)
+
+    # check all valid tokens against the revoked blacklist at once
+    revoked = user_blacklist.tokens_in_blacklist([jti for jti, _ in jwt_data_list])
+    pairs = []
+    allowed = []
+    for i, (_, roles), is_revoked in zip(valid, jwt_data_list, revoked):
+        if is_revoked:
+            results[i].update(error="token in black list", status=401)
+        else:
+            allowed.append(i)
+            pairs.append((roles, in_data[i]["resources"]))
+
+    for i, resources in zip(allowed, user_manger_class.authorize_many(pairs)):
+        results[i]["resources"] = resources
+    failed = len(in_data) - len(allowed)
+    if failed:
+        getLogger().info("batch authorize: {} of {} tokens rejected".format(failed, len(in_data)))
+    return dumps(BatchAuthorizeOutput, results, many=True), 200
+
+
+def user_resources_tag() -> str:
+    """resources_tag of the roles of the request's token"""
+    roles = get_jwt_claims().get("roles")
+    return None if roles is None else resources_tag(roles)
 
 
 @auth_bp.route('/user_resources', methods=['GET'])
 @jwt_required
+@etag_by(user_resources_tag)
 def get_user_resources():
     claims = get_jwt_claims()
     try:
         roles = claims["roles"]
-    except KeyError as e:
-        getLogger().exception(e)
+    except KeyError:
         getLogger().error("no roles in claims")
         return "invalid token", 401
     else:
         try:
-            return ResourceSerializer(exclude=("id", )).dumps(get_user_resources_by_roles(roles), many=True), 200
-        except TypeError as e:
-            getLogger().exception(e)
-            getLogger().error("token '{}' have no roles so have no allowed resources".format(get_raw_jwt()))
+            return dumps(ResourceSerializer, user_manger_class.user_resources(roles), many=True, exclude=("id", )), 200
+        except TypeError:
+            getLogger().error(
+                "token with jti '{}' have no roles so have no allowed resources".format(get_raw_jwt()["jti"])
+            )
             return jsonify([]), 200
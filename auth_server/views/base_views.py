@@ -1,12 +1,67 @@
 from logging import getLogger
-from flask import request
+from urllib.parse import urlencode
+from flask import request, current_app, Response, stream_with_context
 from flask.views import MethodView
 from marshmallow import Schema, ValidationError
 from auth_server.models.auth_model import get_all_many_many_as_sub, get_one_many_many_as_sub, insert_to_table, \
     delete_from_relation_table
 from auth_server.models.errors import DoesNotExist, DuplicateConstraint, ConstraintViolation
 from auth_server.models.utils import CrudModel
-from auth_server.serializers.identity_serializers import IdSerializer
+from auth_server.serializers.identity_serializers import IdSerializer, BulkCreateOutput
+from auth_server.utils.password import HashingBusy
+from auth_server.utils.policy import identity_changed, identity_tag
+from auth_server.utils.view_utils import etag_by
+
+
+NDJSON = "application/x-ndjson"
+
+
+def page_args() -> tuple:
+    """Returns the 'after' and 'limit' query arguments of the request, None for the absent ones
+
+    :raises ValueError: if they are not integers or limit is out of range.
+    """
+    after = request.args.get("after", type=int)
+    limit = request.args.get("limit", type=int)
+    if request.args.get("after") is not None and after is None:
+        raise ValueError("after should be an id")
+    if request.args.get("limit") is not None and limit is None:
+        raise ValueError("limit should be an integer")
+    if limit is not None and not 0 < limit <= current_app.config["PAGE_SIZE_MAX"]:
+        raise ValueError("limit should be between 1 and {}".format(current_app.config["PAGE_SIZE_MAX"]))
+    return after, limit
+
+
+def wants_ndjson() -> bool:
+    """Whether the client asked for one json document per line, by the Accept header or format=ndjson"""
+    return (
+        request.args.get("format") == "ndjson" or
+        request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON
+    )
+
+
+def ndjson_response(rows, serializer: Schema) -> Response:
+    """Streams the rows as they are read, one serialized row per line"""
+    return Response(
+        stream_with_context(serializer.dumps(row) + "\n" for row in rows),
+        mimetype=NDJSON
+    )
+
+
+def listing_tag() -> str:
+    """identity_tag of the representation the client asked for, json or ndjson"""
+    tag = identity_tag()
+    return tag + "-ndjson" if wants_ndjson() else tag
+
+
+def page_response(records: list, serializer: Schema, limit) -> tuple:
+    """Returns the serialized page with a Link header to the next page if the page is full"""
+    headers = {}
+    if limit is not None and len(records) == limit:
+        args = request.args.to_dict()
+        args["after"] = records[-1].id
+        headers["Link"] = '<{}?{}>; rel="next"'.format(request.base_url, urlencode(args))
+    return serializer.dumps(records, many=True), 200, headers
 
 
 class BasicCrudView(MethodView):
@@ -18,11 +73,28 @@ class BasicCrudView(MethodView):
     # should be a Marshmallow schema
     serializer = Schema
 
+    # whether writes to the model change authorization decisions
+    affects_policy = False
+
+    @etag_by(listing_tag)
     def get(self, id):
-        """Returns all resources or one by id"""
+        """Returns all resources or one by id
+
+        responses are tagged by the identity version, so unchanged ones are revalidated without reading them.
+        the list is paginated by the 'after' and 'limit' query arguments and
+        streamed as ndjson if the client asks for it.
+        """
         # returns all records of the model
         if id is None:
-            return self.serializer().dumps(self.model.get_all(), many=True), 200
+            try:
+                after, limit = page_args()
+            except ValueError as e:
+                return str(e), 422
+            if wants_ndjson():
+                return ndjson_response(self.model.stream(after, limit), self.serializer())
+            if after is None and limit is None:
+                return self.serializer().dumps(self.model.get_all(), many=True), 200
+            return page_response(self.model.get_page(after, limit), self.serializer(), limit)
         # returns a record by id
         else:
             try:
@@ -33,23 +105,63 @@ class BasicCrudView(MethodView):
                 return self.serializer().dumps(record), 200
 
     def post(self):
-        """creates new resource"""
+        """creates new resource, or new resources if the body is a list"""
         serializer_obj = self.serializer()
         json_data = request.get_json()
         if json_data is None:
             return "Invalid json", 400
+        if isinstance(json_data, list):
+            return self.post_many(json_data)
         try:
             data = serializer_obj.load(json_data)
         except ValidationError as e:
-            getLogger().exception(e)
+            getLogger().info("validation error for {}: {}".format(self.__class__.__name__, e.messages))
             return "validation error for: {}".format(e.field_names), 422
+        except HashingBusy:
+            getLogger().warning("no password hashing worker got free for the create")
+            return "too many passwords being hashed, try again later", 503, {"Retry-After": "1"}
         else:
             try:
                 id = self.model.create(data)
             except DuplicateConstraint:
                 return "Resource already exists", 409
+            identity_changed(self.affects_policy)
             return serializer_obj.dumps({"id": id}), 201
 
+    def post_many(self, json_data: list):
+        """Creates the resources of the list and returns a result per item in the same order
+
+        an item carries the id and 201 if it is created, otherwise an error message and the http status
+        the single post would return. lists longer than BULK_CREATE_MAX_ITEMS are refused, so hashing their
+        passwords cannot outlast the worker timeout.
+        """
+        max_items = current_app.config["BULK_CREATE_MAX_ITEMS"]
+        if len(json_data) > max_items:
+            return "at most {} items are allowed in a bulk create".format(max_items), 422
+        serializer_obj = self.serializer()
+        results = [{"status": 201} for _ in json_data]
+        errors = serializer_obj.validate(json_data, many=True)
+        for i, messages in errors.items():
+            results[i].update(status=422, error="validation error for: {}".format(list(messages)))
+        valid = [i for i in range(len(json_data)) if i not in errors]
+        try:
+            data = serializer_obj.load([json_data[i] for i in valid], many=True)
+        except HashingBusy:
+            getLogger().warning("no password hashing worker got free for the bulk create")
+            return "too many passwords being hashed, try again later", 503, {"Retry-After": "1"}
+        try:
+            ids = self.model.create_many(data, chunk_size=current_app.config["BULK_CREATE_CHUNK_SIZE"])
+        except ConstraintViolation:
+            return "Resources violate a system constraint, none is created", 409
+        for i, id in zip(valid, ids):
+            if id is None:
+                results[i].update(status=409, error="Resource already exists")
+            else:
+                results[i]["id"] = id
+        if any(id is not None for id in ids):
+            identity_changed(self.affects_policy)
+        return BulkCreateOutput(many=True).dumps(results), 200
+
     def patch(self, id):
         """update resource"""
         serializer_obj = self.serializer()
@@ -59,8 +171,11 @@ class BasicCrudView(MethodView):
         try:
             data = serializer_obj.load(request.get_json(), partial=True)
         except ValidationError as e:
-            getLogger().exception(e)
+            getLogger().info("validation error for {}: {}".format(self.__class__.__name__, e.messages))
             return "validation error for: {}".format(e.field_names), 422
+        except HashingBusy:
+            getLogger().warning("no password hashing worker got free for the update")
+            return "too many passwords being hashed, try again later", 503, {"Retry-After": "1"}
         else:
             try:
                 self.model.update(id=id, data=data)
@@ -68,6 +183,7 @@ class BasicCrudView(MethodView):
                 return "Resource Does not exist", 404
             except DuplicateConstraint:
                 return "Resource with same constrained values already exists", 409
+            identity_changed(self.affects_policy)
             return "", 204
 
     def delete(self, id):
@@ -75,6 +191,7 @@ class BasicCrudView(MethodView):
             self.model.delete(id)
         except DoesNotExist:
             return "Resource Does not exist", 404
+        identity_changed(self.affects_policy)
         return "", 204
 
 
@@ -97,16 +214,28 @@ class ManyManySubResource(MethodView):
     # sub resource serializer
     serializer = Schema
 
+    # whether writes to the relation table change authorization decisions
+    affects_policy = False
+
+    @etag_by(listing_tag)
     def get(self, base_id, id):
-        """Returns all resources or one by id"""
+        """Returns all resources or one by id, tagged like BasicCrudView.get"""
         serializer_obj = self.serializer()
         # returns all records of the model
         if id is None:
+            try:
+                after, limit = page_args()
+            except ValueError as e:
+                return str(e), 422
+            stream = wants_ndjson()
             db_data = get_all_many_many_as_sub(
                 self.base_model, self.sub_model, self.relation_table,
-                self.relation_field_to_base, self.relation_field_to_sub, base_id, self.fields
+                self.relation_field_to_base, self.relation_field_to_sub, base_id, self.fields,
+                after=after, limit=limit, stream=stream
             )
-            return serializer_obj.dumps(db_data, many=True), 200
+            if stream:
+                return ndjson_response(db_data, serializer_obj)
+            return page_response(db_data, serializer_obj, limit)
         # returns a record by id
         else:
             db_data = get_one_many_many_as_sub(
@@ -126,7 +255,7 @@ class ManyManySubResource(MethodView):
         try:
             data = serializer_obj.load(json_data)
         except ValidationError as e:
-            getLogger().exception(e)
+            getLogger().info("validation error for {}: {}".format(self.__class__.__name__, e.messages))
             return "validation error for: {}".format(e.field_names), 422
         else:
             data[self.relation_field_to_base] = base_id
@@ -135,6 +264,7 @@ class ManyManySubResource(MethodView):
                 insert_to_table(self.relation_table, data)
             except ConstraintViolation:
                 return "Resource already exists or system constraint", 409
+            identity_changed(self.affects_policy)
             return "", 204
 
     def delete(self, base_id, id):
@@ -146,6 +276,7 @@ class ManyManySubResource(MethodView):
             id
         )
         if r:
+            identity_changed(self.affects_policy)
             return "", 204
         else:
             return "Resource Does not exist", 404
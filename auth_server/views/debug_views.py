@@ -0,0 +1,46 @@
+import os
+import tracemalloc
+from flask import request
+from flask.views import MethodView
+from auth_server.serializers.debug_serializers import TracemallocOutput
+from auth_server.serializers.registry import dumps
+from auth_server.utils.jwt import access_required
+from auth_server.utils.profiling import DEBUG_RESOURCE, memory_tracer
+
+KEY_TYPES = ("lineno", "filename", "traceback")
+
+
+class TracemallocView(MethodView):
+    """tracemalloc of the worker serving the request, a worker is chosen per request by the server"""
+    resource_names = [DEBUG_RESOURCE]
+    decorators = [access_required(resource_names)]
+
+    def get(self):
+        """Returns the allocations grown the most since the previous snapshot of this worker
+
+        the 'key_type' query argument groups them by lineno, filename or traceback, 'limit' caps their number.
+        """
+        key_type = request.args.get("key_type", "lineno")
+        limit = request.args.get("limit", 20, type=int)
+        if key_type not in KEY_TYPES:
+            return "key_type should be one of {}".format(", ".join(KEY_TYPES)), 422
+        if not memory_tracer.tracing:
+            return "tracemalloc is not tracing, start it by a post", 409
+        stats = memory_tracer.diff(key_type=key_type, limit=limit)
+        traced_size, peak_size = tracemalloc.get_traced_memory()
+        return dumps(TracemallocOutput, {
+            "pid": os.getpid(), "traced_size": traced_size, "peak_size": peak_size, "stats": stats
+        }), 200
+
+    def post(self):
+        """Starts tracing, the 'frames' query argument is the depth of the tracebacks kept per allocation"""
+        frames = request.args.get("frames", 1, type=int)
+        if not 0 < frames <= 100:
+            return "frames should be between 1 and 100", 422
+        memory_tracer.start(frames)
+        return "", 204
+
+    def delete(self):
+        """Stops tracing and frees the traces"""
+        memory_tracer.stop()
+        return "", 204
@@ -1,10 +1,69 @@
-from flask_admin import expose, AdminIndexView
+import hashlib
+import hmac
+import os
+from logging import getLogger
+import redis
+from flask_admin import expose, AdminIndexView, BaseView
 from flask_admin.contrib.sqla import ModelView
-from auth_server import db_wrapper
+from auth_server import db_wrapper, authorization_cache, jwt_cache, admin_auth_cache, identity_version
 from auth_server.config import url_prefix
-from auth_server.models.auth_model import Users, Resources, Roles, get_resources_by_user_pass
-from flask import request, Response
-from auth_server.utils.password import hash_password
+from auth_server.models.auth_model import Users, Resources, Roles
+from flask import request, Response, g
+from auth_server.user_manager.local_user_manager import LocalUserManager
+from auth_server.utils.password import HashingBusy
+from auth_server.utils.policy import identity_changed
+
+# key of the credential digests, random per worker so admin_auth_cache holds nothing usable elsewhere
+credentials_key = os.urandom(32)
+
+
+def credentials_digest(username: str, password: str) -> bytes:
+    # the username is length prefixed, so no other pair of username and password has the same message
+    message = "{}:{}{}".format(len(username), username, password).encode("utf-8")
+    return hmac.new(credentials_key, message, hashlib.sha256).digest()
+
+
+def admin_roles(username: str, password: str) -> list:
+    """Returns the roles of the user if the password matches, None otherwise
+
+    successful authentications are cached in admin_auth_cache by a digest of the credentials, along with the
+    identity version they are made at, so a change of users or roles by any worker authenticates them again.
+    :raises HashingBusy: if no password hashing worker got free in time.
+    """
+    key = credentials_digest(username, password)
+    try:
+        version = identity_version.current()
+    except redis.RedisError as e:
+        getLogger().warning("admin authentication is not cached, redis is not available: {}".format(e))
+        version = None
+    if version is not None:
+        cached = admin_auth_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    user = LocalUserManager(username, password=password).authenticate()
+    if user is None:
+        return None
+    roles = [r for r in user["roles"] if r is not None]
+    if version is not None:
+        admin_auth_cache.set(key, (version, roles))
+    return roles
+
+
+def has_access(resources: set) -> bool:
+    """Whether the basic auth user of the request is allowed all of the resources
+
+    the user is authenticated once per request, the menu of a page checks the access of every view.
+    """
+    if not request.authorization:
+        return False
+    if "admin_roles" not in g:
+        try:
+            g.admin_roles = admin_roles(request.authorization.username, request.authorization.password)
+        except HashingBusy:
+            return False
+    if g.admin_roles is None:
+        return False
+    return all(v is not False for v in LocalUserManager.authorize(g.admin_roles, resources).values())
 
 
 class RestrictedModelView:
@@ -18,12 +77,7 @@ class RestrictedModelView:
     }
 
     def is_accessible(self):
-        if request.authorization:
-            accessible_resources = get_resources_by_user_pass(
-                request.authorization.username, hash_password(request.authorization.password))
-            return self.resources in accessible_resources or self.resources == accessible_resources
-        else:
-            return False
+        return has_access(self.resources)
 
     def inaccessible_callback(self, name, **kwargs):
         return Response(
@@ -35,12 +89,7 @@ class RestrictedModelView:
 class IndexView(AdminIndexView, RestrictedModelView):
 
     def is_accessible(self):
-        if request.authorization:
-            accessible_resources = get_resources_by_user_pass(
-                request.authorization.username, hash_password(request.authorization.password))
-            return self.resources in accessible_resources or self.resources == accessible_resources
-        else:
-            return False
+        return has_access(self.resources)
 
     def inaccessible_callback(self, name, **kwargs):
         return Response(
@@ -53,7 +102,20 @@ class IndexView(AdminIndexView, RestrictedModelView):
         return super().index()
 
 
-class UserModelView(RestrictedModelView, ModelView):
+class IdentityModelView:
+    """Bumps the identity version after changes from the admin panel,
+    and invalidates authorization caches if they change authorization decisions"""
+
+    affects_policy = False
+
+    def after_model_change(self, form, model, is_created):
+        identity_changed(self.affects_policy)
+
+    def after_model_delete(self, model):
+        identity_changed(self.affects_policy)
+
+
+class UserModelView(RestrictedModelView, IdentityModelView, ModelView):
 
     page_size = 50
     column_exclude_list = ['password', ]
@@ -62,22 +124,34 @@ class UserModelView(RestrictedModelView, ModelView):
     column_list = ['username', 'display_name', 'service_name', 'roles']
 
 
-class RoleModelView(RestrictedModelView, ModelView):
+class RoleModelView(RestrictedModelView, IdentityModelView, ModelView):
     page_size = 50
+    affects_policy = True
     column_searchable_list = ['name']
     column_hide_backrefs = False
     column_list = ['name', 'description', 'users', 'resources']
 
 
-class ResourceModelView(RestrictedModelView, ModelView):
+class ResourceModelView(RestrictedModelView, IdentityModelView, ModelView):
     page_size = 50
+    affects_policy = True
     column_searchable_list = ['path']
     column_hide_backrefs = False
     column_list = ['path', 'description', 'roles']
 
 
+class CachesView(RestrictedModelView, BaseView):
+
+    @expose('/')
+    def index(self):
+        return self.render(
+            'admin/caches.html', caches=[c.stats() for c in (authorization_cache, jwt_cache, admin_auth_cache)]
+        )
+
+
 def register():
     from auth_server import admin
     admin.add_view(UserModelView(Users, db_wrapper.session))
     admin.add_view(RoleModelView(Roles, db_wrapper.session))
     admin.add_view(ResourceModelView(Resources, db_wrapper.session))
+    admin.add_view(CachesView(name='Caches', endpoint='caches'))
@@ -1,12 +1,18 @@
+import base64
+import binascii
 from logging import getLogger
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask import Blueprint, request, Response, current_app
+from flask_jwt_extended import get_jwt_identity
 from marshmallow import ValidationError
 from auth_server.config import url_prefix
 from auth_server.models.auth_model import Users, Roles, Resources, user_roles, resource_roles
 from auth_server.models.errors import DoesNotExist
-from auth_server.serializers.identity_serializers import UserSerializer, RoleSerializer, ResourceSerializer
-from auth_server.utils.jwt import access_required
+from auth_server.serializers.identity_serializers import (
+    UserSerializer, RoleSerializer, ResourceSerializer, AVATAR_MIMETYPES
+)
+from auth_server.utils.jwt import access_required, jwt_required
+from auth_server.utils.password import HashingBusy
+from auth_server.utils.policy import identity_changed
 from auth_server.utils.view_utils import json_or_400
 from auth_server.views.base_views import BasicCrudView, ManyManySubResource
 
@@ -30,6 +36,7 @@ class RolesView(BasicCrudView):
         url_prefix[1:] + ':roles:w'
     ]
     decorators = [access_required(resource_names)]
+    affects_policy = True
 
     model = Roles
     serializer = RoleSerializer
@@ -41,6 +48,7 @@ class ResourcesView(BasicCrudView):
         url_prefix[1:] + ':resources:w'
     ]
     decorators = [access_required(resource_names)]
+    affects_policy = True
 
     model = Resources
     serializer = ResourceSerializer
@@ -89,6 +97,7 @@ class RoleResourcesView(ManyManySubResource):
         url_prefix[1:] + ':resources:r',
     ]
     decorators = [access_required(resource_names)]
+    affects_policy = True
 
     base_model = Roles
     relation_table = resource_roles
@@ -107,6 +116,7 @@ class ResourceRolesView(ManyManySubResource):
         url_prefix[1:] + ':roles:r',
     ]
     decorators = [access_required(resource_names)]
+    affects_policy = True
 
     base_model = Resources
     relation_table = resource_roles
@@ -136,12 +146,77 @@ def update_user_info():
     try:
         in_data = UserSerializer(partial=True).load(request.get_json())
     except ValidationError as e:
-        getLogger().exception(e)
         getLogger().error("validation error for update_user_info request: {}".format(e))
         return "bad format input for fields: {}".format(e.field_names), 422
+    except HashingBusy:
+        getLogger().warning("no password hashing worker got free for update_user_info request")
+        return "too many passwords being hashed, try again later", 503, {"Retry-After": "1"}
     else:
-        count = Users.update(**in_data).where(Users.id == id).execute()
-        if count < 1:
+        try:
+            Users.update(id=id, data=in_data)
+        except DoesNotExist:
             return "resource does not exists anymore", 404
         else:
+            identity_changed()
             return "", 204
+
+
+def decode_avatar(avatar: str) -> tuple:
+    """Returns the mimetype and content of the avatar, data URIs are decoded
+
+    avatars stored before their type was checked on upload are served as application/octet-stream unless they
+    are of AVATAR_MIMETYPES, so a browser never renders a script or a page out of them.
+    """
+    if avatar.startswith("data:") and "," in avatar:
+        meta, data = avatar[5:].split(",", 1)
+        mimetype = meta.split(";")[0]
+        if mimetype not in AVATAR_MIMETYPES:
+            mimetype = "application/octet-stream"
+        if meta.endswith(";base64"):
+            try:
+                return mimetype, base64.b64decode(data)
+            except (binascii.Error, ValueError):
+                getLogger().warning("avatar is not valid base64, served as it is")
+        else:
+            return mimetype, data
+    return "application/octet-stream", avatar
+
+
+def avatar_response(user_id) -> Response:
+    """Serves the avatar of the user with its md5 as the ETag
+
+    requests carrying the md5 as the 'v' query argument, as built from avatar_hash, may be cached for
+    AVATAR_MAX_AGE seconds since their content never changes, the others are revalidated by the ETag.
+    """
+    try:
+        avatar_hash = Users.get_avatar_hash(user_id)
+    except DoesNotExist:
+        return "resource does not exists anymore", 404
+    if avatar_hash is None:
+        return "user has no avatar", 404
+    if request.if_none_match.contains(avatar_hash):
+        response = Response(status=304)
+    else:
+        mimetype, content = decode_avatar(Users.get_avatar(user_id))
+        response = Response(content, mimetype=mimetype)
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        response.headers["Content-Disposition"] = "inline; filename=avatar"
+    response.set_etag(avatar_hash)
+    response.cache_control.private = True
+    if request.args.get("v") == avatar_hash:
+        response.cache_control.max_age = current_app.config["AVATAR_MAX_AGE"]
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+@identity_bp.route('/user_info/avatar', methods=['GET'])
+@jwt_required
+def get_user_info_avatar():
+    return avatar_response(get_jwt_identity())
+
+
+@identity_bp.route('/users/<string:id>/avatar', methods=['GET'])
+@access_required([url_prefix[1:] + ':users:r'])
+def get_user_avatar(id):
+    return avatar_response(id)
@@ -0,0 +1,345 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+import fakeredis
+from auth_server import (
+    PROFILES, create_app, db_wrapper, blacklist, policy_version, identity_version, authorization_cache, jwt_cache
+)
+from auth_server.models.auth_model import Roles, Resources, resource_roles
+
+FORMAT_VERSION = 1
+
+# name and setup function of each benchmark, the setup returns the function to be timed
+benchmarks = []
+
+
+def benchmark(name: str):
+    def decorator(setup):
+        benchmarks.append((name, setup))
+        return setup
+    return decorator
+
+
+def parse_input():
+    arg_parser = argparse.ArgumentParser(
+        description="Times the hot paths of the server against in-memory sqlite and a fake redis"
+    )
+    sub_parsers = arg_parser.add_subparsers(dest="command")
+    sub_parsers.required = True
+    run_parser = sub_parsers.add_parser("run", help="runs the benchmarks and writes their results as json")
+    run_parser.add_argument("output", type=str, help="the file the results are written to")
+    run_parser.add_argument("--runs", type=int, default=5, help="timed runs of each benchmark, default is 5")
+    run_parser.add_argument(
+        "--min-time", type=float, default=0.1,
+        help="seconds each run should take at least, the calls of a run are doubled until it does. default is 0.1"
+    )
+    run_parser.add_argument("--filter", type=str, default="", help="runs only the benchmarks whose name contains it")
+    run_parser.add_argument("--roles", type=int, default=50, help="number of roles, default is 50")
+    run_parser.add_argument("--resources", type=int, default=2000, help="number of resources, default is 2000")
+    run_parser.add_argument(
+        "--revoked", type=int, default=10000, help="number of tokens in the blacklist, default is 10000"
+    )
+    compare_parser = sub_parsers.add_parser(
+        "compare", help="compares two results by their medians, fails if a benchmark got slower than the threshold"
+    )
+    compare_parser.add_argument("base", type=str)
+    compare_parser.add_argument("new", type=str)
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="allowed slowdown ratio, default is 0.1 meaning 10%%"
+    )
+    return vars(arg_parser.parse_args())
+
+
+class Fixture:
+    """The data the benchmarks share, loaded into in-memory sqlite and a fake redis"""
+
+    def __init__(self, roles: int, resources: int, revoked: int):
+        rand = random.Random(0)
+        self.resource_paths = ["service{}:resource{}:{}".format(i % 20, i, "rw"[i % 2]) for i in range(resources)]
+        # a wildcard per service, granted to a few roles
+        self.resource_paths += ["service{}:*".format(i) for i in range(20)]
+        db_wrapper.create_all()
+        db_wrapper.session.execute(Resources.__table__.insert(), [
+            {"id": i + 1, "path": path, "value": None if i % 3 else str(i)}
+            for i, path in enumerate(self.resource_paths)
+        ])
+        db_wrapper.session.execute(Roles.__table__.insert(), [
+            {"id": i + 1, "name": "role{}".format(i)} for i in range(roles)
+        ])
+        db_wrapper.session.execute(resource_roles.insert(), [
+            {"role_id": role, "resource_id": resource}
+            for role in range(1, roles + 1)
+            for resource in rand.sample(range(1, len(self.resource_paths) + 1), len(self.resource_paths) // 10)
+        ])
+        db_wrapper.session.commit()
+        self.roles = rand.sample(range(1, roles + 1), min(5, roles))
+        self.requested = rand.sample(self.resource_paths[:resources], 8) + ["service3:extra:r", "unknown:path:r"]
+        self.password = "benchmark password"
+
+        redis_client = fakeredis.FakeStrictRedis()
+        redis_client.flushall()
+        blacklist.init_app(db_wrapper.get_app(), redis_client)
+        policy_version.init_app(db_wrapper.get_app(), redis_client)
+        identity_version.init_app(db_wrapper.get_app(), redis_client)
+        for i in range(revoked):
+            blacklist.persist_token_in_blacklist("revoked-{}".format(i))
+
+
+@benchmark("hash_password")
+def hash_password_setup(fixture: Fixture):
+    from auth_server.utils.password import hash_password
+    return lambda: hash_password(fixture.password)
+
+
+@benchmark("verify_password")
+def verify_password_setup(fixture: Fixture):
+    from auth_server.utils.password import password_hasher
+    encoded = password_hasher.hash(fixture.password)
+    return lambda: password_hasher.verify(fixture.password, encoded)
+
+
+def access_token(fixture: Fixture) -> str:
+    from auth_server.utils.jwt import encode_access_token
+    return encode_access_token({"id": 1, "service_name": None, "roles": list(fixture.roles)})
+
+
+@benchmark("decode_jwt_verify_token_claims")
+def decode_jwt_setup(fixture: Fixture):
+    from flask_jwt_extended.config import config
+    from flask_jwt_extended.tokens import decode_jwt
+    from flask_jwt_extended.utils import verify_token_claims
+    from auth_server import key_ring
+    token = access_token(fixture)
+
+    def run():
+        jwt_data = decode_jwt(
+            encoded_token=token,
+            secret=key_ring.verifying_key(token),
+            algorithm=key_ring.algorithm,
+            identity_claim_key=config.identity_claim_key,
+            user_claims_key=config.user_claims_key
+        )
+        verify_token_claims(jwt_data)
+    return run
+
+
+@benchmark("decode_verified_token_cached")
+def decode_verified_token_setup(fixture: Fixture):
+    from auth_server.utils.jwt import decode_verified_token
+    token = access_token(fixture)
+    return lambda: decode_verified_token(token)
+
+
+@benchmark("authorize")
+def authorize_setup(fixture: Fixture):
+    from auth_server.user_manager.local_user_manager import LocalUserManager
+    authorization_cache.configure(maxsize=0, ttl=0)
+    return lambda: LocalUserManager.authorize(roles=fixture.roles, resources=fixture.requested)
+
+
+@benchmark("authorize_cached")
+def authorize_cached_setup(fixture: Fixture):
+    from auth_server.user_manager.local_user_manager import LocalUserManager
+    authorization_cache.configure(maxsize=10000, ttl=3600)
+    return lambda: LocalUserManager.authorize(roles=fixture.roles, resources=fixture.requested)
+
+
+@benchmark("authorize_many_100")
+def authorize_many_setup(fixture: Fixture):
+    from auth_server.user_manager.local_user_manager import LocalUserManager
+    authorization_cache.configure(maxsize=0, ttl=0)
+    rand = random.Random(1)
+    requests = [
+        (rand.sample(fixture.roles, 2), rand.sample(fixture.resource_paths, 5)) for _ in range(100)
+    ]
+    return lambda: LocalUserManager.authorize_many(requests)
+
+
+@benchmark("user_resources")
+def user_resources_setup(fixture: Fixture):
+    from auth_server.user_manager.local_user_manager import LocalUserManager
+    return lambda: LocalUserManager.user_resources(fixture.roles)
+
+
+@benchmark("token_in_blacklist")
+def token_in_blacklist_setup(fixture: Fixture):
+    return lambda: blacklist.token_in_blacklist("not-revoked")
+
+
+@benchmark("tokens_in_blacklist_100")
+def tokens_in_blacklist_setup(fixture: Fixture):
+    jtis = ["revoked-{}".format(i) for i in range(50)] + ["not-revoked-{}".format(i) for i in range(50)]
+    return lambda: blacklist.tokens_in_blacklist(jtis)
+
+
+def authorize_output(fixture: Fixture) -> dict:
+    from auth_server.user_manager.local_user_manager import LocalUserManager
+    return {
+        "token": access_token(fixture),
+        "resources": LocalUserManager.authorize(roles=fixture.roles, resources=fixture.requested)
+    }
+
+
+@benchmark("serialize_authorize_output")
+def serialize_authorize_output_setup(fixture: Fixture):
+    from auth_server.serializers.auth_serializers import AuthorizeOutput
+    from auth_server.serializers.registry import dumps
+    data = authorize_output(fixture)
+    return lambda: dumps(AuthorizeOutput, data)
+
+
+@benchmark("serialize_authorize_output_marshmallow")
+def serialize_authorize_output_marshmallow_setup(fixture: Fixture):
+    from auth_server.serializers.auth_serializers import AuthorizeOutput
+    data = authorize_output(fixture)
+    return lambda: AuthorizeOutput().dumps(data)
+
+
+@benchmark("serialize_user_resources")
+def serialize_user_resources_setup(fixture: Fixture):
+    from auth_server.serializers.identity_serializers import ResourceSerializer
+    from auth_server.serializers.registry import dumps
+    from auth_server.user_manager.local_user_manager import LocalUserManager
+    resources = LocalUserManager.user_resources(fixture.roles)
+    return lambda: dumps(ResourceSerializer, resources, many=True, exclude=("id", ))
+
+
+@benchmark("serialize_user_resources_marshmallow")
+def serialize_user_resources_marshmallow_setup(fixture: Fixture):
+    from auth_server.serializers.identity_serializers import ResourceSerializer
+    from auth_server.user_manager.local_user_manager import LocalUserManager
+    resources = LocalUserManager.user_resources(fixture.roles)
+    return lambda: ResourceSerializer(exclude=("id", )).dumps(resources, many=True)
+
+
+STARTUP_SCRIPT = "from auth_server import create_app; create_app({{'SQLALCHEMY_DATABASE_URI': 'sqlite://'}}, profile='{}')"
+
+
+def startup_setup(profile: str):
+    """Times the cold start of a worker of the profile, a new interpreter importing the package and creating the app"""
+    def setup(fixture: Fixture):
+        command = [sys.executable, "-c", STARTUP_SCRIPT.format(profile)]
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        return lambda: subprocess.check_call(command, cwd=cwd, stdout=subprocess.DEVNULL)
+    return setup
+
+
+for app_profile in PROFILES:
+    benchmark("startup_" + app_profile)(startup_setup(app_profile))
+
+
+def time_calls(fn, loops: int) -> float:
+    start = time.perf_counter()
+    for _ in range(loops):
+        fn()
+    return time.perf_counter() - start
+
+
+def measure(fn, runs: int, min_time: float) -> dict:
+    """Times fn like pyperf does, calibrates the calls of a run to take min_time, warms up and then times the runs
+
+    :return: the seconds per call of each run and their statistics.
+    """
+    loops = 1
+    while time_calls(fn, loops) < min_time:
+        loops *= 2
+    time_calls(fn, loops)
+    values = [time_calls(fn, loops) / loops for _ in range(runs)]
+    return {
+        "unit": "second",
+        "loops": loops,
+        "values": values,
+        "mean": statistics.mean(values),
+        "median": statistics.median(values),
+        "stdev": statistics.stdev(values) if len(values) > 1 else 0.0,
+        "min": min(values),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(output: str, runs: int, min_time: float, filter: str, roles: int, resources: int, revoked: int):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    results = []
+    with app.app_context():
+        fixture = Fixture(roles, resources, revoked)
+        for name, setup in benchmarks:
+            if filter not in name:
+                continue
+            authorization_cache.configure(
+                maxsize=app.config["AUTHORIZATION_CACHE_SIZE"], ttl=app.config["AUTHORIZATION_CACHE_TTL"]
+            )
+            jwt_cache.clear()
+            result = measure(setup(fixture), runs, min_time)
+            result["name"] = name
+            results.append(result)
+            print("{:<40} {:>12.2f} us +- {:.2f}".format(name, result["median"] * 1e6, result["stdev"] * 1e6),
+                  file=sys.stderr)
+        metadata = {
+            "commit": git_commit(),
+            "date": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "roles": roles,
+            "resources": resources,
+            "revoked": revoked,
+            "runs": runs,
+            "min_time": min_time,
+            "password_hasher": app.config["PASSWORD_HASHER"],
+            "password_pbkdf2_iterations": app.config["PASSWORD_PBKDF2_ITERATIONS"],
+            "jwt_algorithm": app.config["JWT_ALGORITHM"],
+        }
+    with open(output, "w") as out:
+        json.dump({"version": FORMAT_VERSION, "metadata": metadata, "benchmarks": results}, out, indent=2)
+
+
+def compare(base: str, new: str, threshold: float) -> bool:
+    """Prints the change of the median of each benchmark of both results
+
+    :return: False if any of them got slower by more than threshold.
+    """
+    with open(base) as f:
+        base_data = json.load(f)
+    with open(new) as f:
+        new_data = json.load(f)
+    for key in sorted(set(base_data["metadata"]) - {"commit", "date"}):
+        if base_data["metadata"][key] != new_data["metadata"].get(key):
+            print("{} differs: {} and {}".format(key, base_data["metadata"][key], new_data["metadata"].get(key)))
+    base_results = {b["name"]: b for b in base_data["benchmarks"]}
+    new_results = {b["name"]: b for b in new_data["benchmarks"]}
+    passed = True
+    for name in sorted(base_results.keys() & new_results.keys()):
+        ratio = new_results[name]["median"] / base_results[name]["median"]
+        regressed = ratio > 1 + threshold
+        passed = passed and not regressed
+        print("{:<40} {:>12.2f} us {:>12.2f} us {:>8.2f}x{}".format(
+            name, base_results[name]["median"] * 1e6, new_results[name]["median"] * 1e6, ratio,
+            "  slower" if regressed else ""
+        ))
+    for name in sorted(base_results.keys() ^ new_results.keys()):
+        print("{:<40} only in {}".format(name, base if name in base_results else new))
+    return passed
+
+
+if __name__ == '__main__':
+    in_data = parse_input()
+    command = in_data.pop("command")
+    if command == "run":
+        os.environ.setdefault("JWT_SECRET_KEY", "benchmark")
+        run(**in_data)
+    elif not compare(**in_data):
+        sys.exit(1)
@@ -0,0 +1,6 @@
+from auth_server.utils.metrics import clear_multiprocess_dir
+
+
+def on_starting(server):
+    # the workers of the previous run left their samples in the metrics directory
+    clear_multiprocess_dir()
@@ -0,0 +1,146 @@
+import argparse
+import gzip
+import sys
+import redis
+from auth_server import create_app, db_wrapper, policy_version, identity_version
+from auth_server.models.auth_model import (
+    Users, Roles, Resources, user_roles, resource_roles,
+    username_hash_index, role_name_hash_index, resource_path_hash_index)
+
+HEADER = b"AUTHSERVER IDENTITY GRAPH 1\n"
+
+END_OF_TABLE = b"\\.\n"
+
+# parents first, so the foreign keys hold while restoring in this order
+tables = [Users.__table__, Roles.__table__, Resources.__table__, user_roles, resource_roles]
+
+# created after the rows are loaded
+deferred_indexes = [username_hash_index, role_name_hash_index, resource_path_hash_index]
+
+
+def parse_input():
+    arg_parser = argparse.ArgumentParser(description="Dumps or restores users, roles, resources and their relations")
+    sub_parsers = arg_parser.add_subparsers(dest="command")
+    sub_parsers.required = True
+    dump_parser = sub_parsers.add_parser("dump", help="writes the identity graph to a gzipped file")
+    dump_parser.add_argument("file", type=str)
+    restore_parser = sub_parsers.add_parser("restore", help="loads a dump into empty tables")
+    restore_parser.add_argument("file", type=str)
+    restore_parser.add_argument(
+        "--truncate", action="store_true", help="empty the tables first instead of refusing to restore into them"
+    )
+    return vars(arg_parser.parse_args())
+
+
+class CopySection:
+    """File-like object reading the rows of one table of a dump up to its end marker, to be fed to COPY"""
+
+    def __init__(self, dump):
+        self.dump = dump
+        self.done = False
+
+    def read(self, size: int=-1) -> bytes:
+        lines = []
+        length = 0
+        while not self.done and (size < 0 or length < size):
+            line = self.dump.readline()
+            if not line:
+                raise ValueError("the dump is truncated")
+            if line == END_OF_TABLE:
+                self.done = True
+            else:
+                lines.append(line)
+                length += len(line)
+        return b"".join(lines)
+
+
+def dump(file: str):
+    """Writes each table as a header line of its name and columns, its rows in COPY text format and an end marker"""
+    connection = db_wrapper.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        with gzip.open(file, "wb") as out:
+            out.write(HEADER)
+            for table in tables:
+                columns = [c.name for c in table.columns]
+                out.write("{} {}\n".format(table.name, ",".join(columns)).encode("utf-8"))
+                cursor.copy_expert("COPY {} ({}) TO STDOUT".format(table.name, ", ".join(columns)), out)
+                out.write(END_OF_TABLE)
+                print("{} rows of {} dumped".format(cursor.rowcount, table.name), file=sys.stderr)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def restore(file: str, truncate: bool):
+    """Loads a dump in a single transaction, the hash indexes are dropped and created again after loading
+
+    :raises ValueError: if the file is not a dump or the tables are not empty and truncate is False.
+    """
+    db_wrapper.create_all()
+    connection = db_wrapper.engine.connect()
+    transaction = connection.begin()
+    try:
+        if truncate:
+            connection.execute("TRUNCATE {} RESTART IDENTITY CASCADE".format(", ".join(t.name for t in tables)))
+        else:
+            for table in tables:
+                if connection.execute("SELECT EXISTS (SELECT 1 FROM {})".format(table.name)).scalar():
+                    raise ValueError("table {} is not empty, restore with --truncate to replace it".format(table.name))
+        for index in deferred_indexes:
+            connection.execute("DROP INDEX IF EXISTS {}".format(index.name))
+
+        cursor = connection.connection.cursor()
+        known_tables = {t.name: t for t in tables}
+        with gzip.open(file, "rb") as dump_file:
+            if dump_file.readline() != HEADER:
+                raise ValueError("{} is not an identity graph dump".format(file))
+            for line in iter(dump_file.readline, b""):
+                name, columns = line.decode("utf-8").split()
+                if name not in known_tables:
+                    raise ValueError("unknown table {} in the dump".format(name))
+                # the names are put into the statement as they are, so only the columns of the table are let in
+                columns = columns.split(",")
+                unknown = [column for column in columns if column not in known_tables[name].columns]
+                if unknown:
+                    raise ValueError("unknown columns {} of table {} in the dump".format(", ".join(unknown), name))
+                cursor.copy_expert("COPY {} ({}) FROM STDIN".format(name, ", ".join(columns)), CopySection(dump_file))
+                print("{} rows of {} restored".format(cursor.rowcount, name), file=sys.stderr)
+
+        for index in deferred_indexes:
+            index.create(bind=connection)
+        for table in tables:
+            if "id" in table.columns:
+                # the ids are copied as they are, so the sequences should continue after them
+                connection.execute(
+                    "SELECT setval(pg_get_serial_sequence('{table}', 'id'), coalesce(max(id), 1), max(id) IS NOT NULL) "
+                    "FROM {table}".format(table=table.name)
+                )
+        transaction.commit()
+    except Exception:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+    for table in tables:
+        db_wrapper.engine.execute("ANALYZE {}".format(table.name))
+
+
+if __name__ == '__main__':
+    in_data = parse_input()
+    app = create_app({})
+    with app.app_context():
+        if in_data["command"] == "dump":
+            dump(in_data["file"])
+        else:
+            try:
+                restore(in_data["file"], in_data["truncate"])
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+            try:
+                # running servers drop what they derived from the old graph
+                policy_version.bump()
+                identity_version.bump()
+            except redis.RedisError as e:
+                print("versions are not bumped, restart the servers: {}".format(e), file=sys.stderr)
@@ -5,6 +5,7 @@ from auth_server.models.auth_model import (
     Users, username_hash_index, Roles, role_name_hash_index,
     resource_path_hash_index, Resources)
 from auth_server.utils.password import hash_password
+from auth_server.views.debug_views import TracemallocView
 from auth_server.views.identity_views import (
     UsersView, ResourcesView, RolesView
 )
@@ -43,7 +44,7 @@ if __name__ == '__main__':
 
         # create resources
         for view in [
-            UsersView, ResourcesView, RolesView
+            UsersView, ResourcesView, RolesView, TracemallocView
         ]:
             for resource_name in view.resource_names:
                 r = db_wrapper.session.query(Resources).filter_by(path=resource_name).first()
@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+from auth_server import authorization_cache
+from auth_server.user_manager.local_user_manager import LocalUserManager
+from auth_server.utils.cache import TTLCache
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_set_of_an_old_generation_is_dropped(self):
+        cache = TTLCache("test", maxsize=10, ttl=60)
+        generation = cache.generation
+        cache.clear()
+        cache.set("key", "stale", generation=generation)
+        self.assertIsNone(cache.get("key"))
+        cache.set("key", "fresh", generation=cache.generation)
+        self.assertEqual(cache.get("key"), "fresh")
+
+    def test_set_without_generation(self):
+        cache = TTLCache("test", maxsize=10, ttl=60)
+        cache.clear()
+        cache.set("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+
+
+class AuthorizeRaceTest(unittest.TestCase):
+    """A policy change clearing the cache while a decision is resolved from the old policy"""
+
+    def setUp(self):
+        authorization_cache.configure(maxsize=100, ttl=60)
+        self.addCleanup(authorization_cache.configure, maxsize=0, ttl=0)
+        patcher = mock.patch("auth_server.user_manager.local_user_manager.policy_index")
+        self.policy_index = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.policy_index.enabled = True
+
+    def old_policy(self, roles, paths):
+        authorization_cache.clear()
+        return [("x:y", None)]
+
+    def test_authorize(self):
+        self.policy_index.allowed.side_effect = self.old_policy
+        self.assertEqual(LocalUserManager.authorize([1], ["x:y"]), {"x:y": True})
+        self.assertEqual(len(authorization_cache), 0)
+        self.policy_index.allowed.side_effect = None
+        self.policy_index.allowed.return_value = []
+        self.assertEqual(LocalUserManager.authorize([1], ["x:y"]), {"x:y": False})
+        self.assertEqual(len(authorization_cache), 1)
+
+    def test_authorize_many(self):
+        self.policy_index.allowed.side_effect = self.old_policy
+        LocalUserManager.authorize_many([([1], ["x:y"]), ([2], ["x:y"])])
+        self.assertEqual(len(authorization_cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
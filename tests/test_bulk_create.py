@@ -0,0 +1,102 @@
+import json
+import tempfile
+import unittest
+from unittest import mock
+from flask import Flask
+from auth_server.serializers.identity_serializers import RoleSerializer, UserSerializer
+from auth_server.utils.password import password_hasher
+from auth_server.views import base_views
+from auth_server.views.base_views import BasicCrudView
+
+
+class FakeModel:
+    """create_many of a table whose 'name' or 'username' is unique, 'admin' already exists"""
+    created = []
+
+    @classmethod
+    def create_many(cls, items: list, chunk_size: int) -> list:
+        ids = []
+        for item in items:
+            cls.created.append(item)
+            name = item.get("name", item.get("username"))
+            ids.append(None if name == "admin" else len(cls.created))
+        return ids
+
+
+class FakeRolesView(BasicCrudView):
+    model = FakeModel
+    serializer = RoleSerializer
+
+
+class FakeUsersView(BasicCrudView):
+    model = FakeModel
+    serializer = UserSerializer
+
+
+def make_app() -> Flask:
+    app = Flask(__name__)
+    app.config.update(
+        BULK_CREATE_CHUNK_SIZE=2,
+        BULK_CREATE_MAX_ITEMS=5,
+        PASSWORD_HASHER="pbkdf2_sha256",
+        PASSWORD_PBKDF2_ITERATIONS=1000,
+        PASSWORD_SCRYPT_N=16384,
+        PASSWORD_SCRYPT_R=8,
+        PASSWORD_SCRYPT_P=1,
+        PASSWORD_HASH_CONCURRENCY=2,
+        PASSWORD_HASH_QUEUE_TIMEOUT=1,
+        PASSWORD_HASH_SLOTS_DIR=tempfile.mkdtemp(),
+    )
+    password_hasher.init_app(app)
+    app.add_url_rule("/roles", view_func=FakeRolesView.as_view("roles"), methods=["POST"])
+    app.add_url_rule("/users", view_func=FakeUsersView.as_view("users"), methods=["POST"])
+    return app
+
+
+class BulkCreateTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeModel.created = []
+        self.client = make_app().test_client()
+        patcher = mock.patch.object(base_views, "identity_changed")
+        self.identity_changed = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_mixed_batch(self):
+        response = self.client.post("/roles", json=[
+            {"name": "r1"}, {"name": "admin"}, {"nameless": 1}, {"name": "r2", "description": "d"}, 5
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)
+        self.assertEqual([result["status"] for result in results], [201, 409, 422, 201, 422])
+        self.assertEqual(results[0]["id"], 1)
+        self.assertEqual(results[3]["id"], 3)
+        self.assertIn("error", results[1])
+        self.assertIn("error", results[2])
+        self.assertEqual([item["name"] for item in FakeModel.created], ["r1", "admin", "r2"])
+        self.identity_changed.assert_called_once()
+
+    def test_passwords_of_valid_items_are_hashed(self):
+        response = self.client.post("/users", json=[
+            {"username": "u1", "password": "password1"}, {"username": "u2", "password": "short"},
+            {"username": "u3", "password": "password3"}
+        ])
+        results = json.loads(response.data)
+        self.assertEqual([result["status"] for result in results], [201, 422, 201])
+        self.assertEqual([item["username"] for item in FakeModel.created], ["u1", "u3"])
+        for item, password in zip(FakeModel.created, ["password1", "password3"]):
+            self.assertTrue(password_hasher.verify(password, item["password"])[0])
+
+    def test_too_many_items(self):
+        response = self.client.post("/roles", json=[{"name": "r{}".format(i)} for i in range(6)])
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(FakeModel.created, [])
+
+    def test_nothing_created(self):
+        response = self.client.post("/roles", json=[{"name": "admin"}])
+        self.assertEqual(json.loads(response.data)[0]["status"], 409)
+        self.identity_changed.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
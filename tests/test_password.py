@@ -0,0 +1,131 @@
+import hashlib
+import multiprocessing
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from flask import Flask
+from auth_server.utils.password import PasswordHasher, HashingSlots, HashingBusy
+
+
+def make_hasher(**config) -> PasswordHasher:
+    app = Flask(__name__)
+    app.config.update(
+        PASSWORD_HASHER="pbkdf2_sha256",
+        PASSWORD_PBKDF2_ITERATIONS=1000,
+        PASSWORD_SCRYPT_N=1024,
+        PASSWORD_SCRYPT_R=8,
+        PASSWORD_SCRYPT_P=1,
+        PASSWORD_HASH_CONCURRENCY=2,
+        PASSWORD_HASH_QUEUE_TIMEOUT=1,
+        PASSWORD_HASH_SLOTS_DIR=tempfile.mkdtemp(),
+    )
+    app.config.update(config)
+    hasher = PasswordHasher()
+    hasher.init_app(app)
+    return hasher
+
+
+def hold_slot(directory: str, seconds: float, held: multiprocessing.Event):
+    slots = HashingSlots(directory, 1)
+    slot = slots.acquire(0, blocking=False)
+    held.set()
+    time.sleep(seconds)
+    slots.release(slot)
+
+
+class HashingSlotsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def hold_in_other_process(self, seconds: float):
+        held = multiprocessing.Event()
+        process = multiprocessing.Process(target=hold_slot, args=(self.directory, seconds, held))
+        process.start()
+        self.addCleanup(process.join)
+        self.assertTrue(held.wait(5))
+
+    def test_slot_taken_by_another_process(self):
+        self.hold_in_other_process(0.5)
+        slots = HashingSlots(self.directory, 1)
+        self.assertIsNone(slots.acquire(0, blocking=False))
+        self.assertIsNone(slots.acquire(0.1))
+
+    def test_waits_for_a_slot_of_another_process(self):
+        self.hold_in_other_process(0.3)
+        slots = HashingSlots(self.directory, 1)
+        started = time.monotonic()
+        slot = slots.acquire(5)
+        self.assertIsNotNone(slot)
+        self.assertLess(time.monotonic() - started, 2)
+        slots.release(slot)
+
+    def test_given_up_wait_frees_the_slot(self):
+        self.hold_in_other_process(0.3)
+        slots = HashingSlots(self.directory, 1)
+        self.assertIsNone(slots.acquire(0.05))
+        slot = slots.acquire(5)
+        self.assertIsNotNone(slot)
+        slots.release(slot)
+
+    def test_threads_of_a_process_are_bounded(self):
+        slots = HashingSlots(self.directory, 2)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def work():
+            slot = slots.acquire(5)
+            with lock:
+                running.append(slot)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(slot)
+            slots.release(slot)
+
+        threads = [threading.Thread(target=work) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(peak), 6)
+        self.assertLessEqual(max(peak), 2)
+
+
+class PasswordHasherTest(unittest.TestCase):
+
+    def test_verify_and_rehash(self):
+        hasher = make_hasher()
+        encoded = hasher.hash("password1")
+        self.assertEqual(hasher.verify("password1", encoded), (True, None))
+        self.assertEqual(hasher.verify("password2", encoded), (False, None))
+        matches, new_hash = hasher.verify("password1", hashlib.sha512(b"password1").hexdigest())
+        self.assertTrue(matches)
+        self.assertTrue(new_hash.startswith("pbkdf2_sha256$"))
+
+    def test_hash_many(self):
+        hasher = make_hasher()
+        passwords = ["password{}".format(i) for i in range(5)]
+        for password, encoded in zip(passwords, hasher.hash_many(passwords)):
+            self.assertTrue(hasher.verify(password, encoded)[0])
+
+    def test_busy(self):
+        hasher = make_hasher()
+        with mock.patch.object(HashingSlots, "acquire", return_value=None):
+            self.assertRaises(HashingBusy, hasher.hash, "password1")
+            self.assertRaises(HashingBusy, hasher.verify_missing, "password1")
+
+    def test_scrypt_without_openssl_support(self):
+        scrypt = getattr(hashlib, "scrypt", None)
+        if scrypt is not None:
+            del hashlib.scrypt
+            self.addCleanup(setattr, hashlib, "scrypt", scrypt)
+        hasher = make_hasher()
+        self.assertEqual(hasher.verify("password1", "scrypt$1024$8$1$c2FsdA==$aGFzaA=="), (False, None))
+        self.assertRaises(ValueError, make_hasher, PASSWORD_HASHER="scrypt")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+from auth_server.models.policy_index import PolicyIndex
+from auth_server.utils.wildcards import expand_paths, match_grants
+
+# resource path -> value, the ids are sparse as left by years of inserts and deletes
+RESOURCES = {
+    "billing:invoices:r": "exact",
+    "billing:invoices:w": "writer",
+    "billing:invoices:*": "invoices",
+    "billing:*": "billing",
+    "reports:monthly:*": None,
+    "secret:*": "secret",
+    "a:*": "a",
+    "a:b:*": "ab",
+    "*": "all",
+}
+
+IDS = {path: 1000 * (i + 1) for i, path in enumerate(RESOURCES)}
+
+# role id -> granted resource paths
+GRANTS = {
+    1: ["billing:invoices:r", "billing:invoices:*", "billing:*", "reports:monthly:*", "a:*"],
+    2: ["secret:*", "billing:invoices:w"],
+    3: ["*", "a:b:*"],
+}
+
+# (roles, requested paths, expected {allowed path: value})
+CASES = [
+    # an exact grant wins over the wildcards covering it
+    ([1], ["billing:invoices:r"], {"billing:invoices:r": "exact"}),
+    # the most specific wildcard wins
+    ([1], ["billing:invoices:w", "billing:x", "billing:x:y"], {
+        "billing:invoices:w": "invoices", "billing:x": "billing", "billing:x:y": "billing"
+    }),
+    # a wildcard does not grant its own prefix
+    ([1], ["billing", "reports:monthly", "reports"], {}),
+    ([1], ["reports:monthly:jan"], {"reports:monthly:jan": None}),
+    # the grants of other roles do not leak
+    ([1], ["secret:a"], {}),
+    # the exact grant of one role wins over the wildcard of another
+    ([1, 2], ["billing:invoices:w", "secret:a:b"], {"billing:invoices:w": "writer", "secret:a:b": "secret"}),
+    # '*' grants everything, below the more specific wildcards
+    ([3], ["x", "x:y", "a:b:c", "a:b", "a:b:c:d"], {
+        "x": "all", "x:y": "all", "a:b:c": "ab", "a:b": "all", "a:b:c:d": "ab"
+    }),
+    ([1, 3], ["a:b:c", "a:x", "billing:invoices:r"], {"a:b:c": "ab", "a:x": "a", "billing:invoices:r": "exact"}),
+    # a requested wildcard path is resolved like any other path
+    ([1], ["billing:*", "billing:invoices:*"], {"billing:*": "billing", "billing:invoices:*": "invoices"}),
+    ([], ["billing:x"], {}),
+    ([4], ["billing:x"], {}),
+]
+
+
+def sql_allowed(roles: list, paths: list) -> dict:
+    """The database path, the query returns the grants of the roles among the expanded paths"""
+    expanded = expand_paths(set(paths))
+    granted = {}
+    for role in roles:
+        granted.update({path: RESOURCES[path] for path in GRANTS.get(role, []) if path in expanded})
+    return dict(match_grants(set(paths), granted))
+
+
+def make_index() -> PolicyIndex:
+    index = PolicyIndex()
+    index.configure(enabled=True, check_interval=3600, fallback_interval=3600, self_refresh=False)
+    index.load(
+        1,
+        [(IDS[path], path, value, None) for path, value in RESOURCES.items()],
+        [(role, IDS[path]) for role, paths in GRANTS.items() for path in paths]
+    )
+    return index
+
+
+class WildcardPrecedenceTest(unittest.TestCase):
+    """The database path and the policy index path resolve the same grants to the same decisions"""
+
+    def test_cases(self):
+        index = make_index()
+        for roles, paths, expected in CASES:
+            with self.subTest(roles=roles, paths=paths):
+                self.assertEqual(sql_allowed(roles, paths), expected)
+                self.assertEqual(dict(index.allowed(set(roles), set(paths))), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()